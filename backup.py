@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+backup.py -- resumable NDJSON export and import of the conference dataset
+
+An export walks Profile, Speaker, Conference, Session, Registration and
+WishlistEntry with datastore cursors, one chunk of EXPORT_BATCH entities per task. Each task stores its
+chunk and advances the ExportJob checkpoint in one transaction and then
+chains the next task, so a failed or repeated task resumes where the last
+committed one stopped. Chunks are downloaded one at a time.
+
+An import takes the same NDJSON back one uploaded chunk at a time and writes
+it with put_multi in IMPORT_BATCH entity batches, checkpointing after each.
+Keys are written as their kind/id paths, not websafe strings, so they are
+rebuilt for whichever application imports them; imported numeric ids are
+reserved so new entities do not get them again. Derived data (seat shards
+are recreated, search documents need /admin/reindex) is not exported.
+
+Throughput is set by the batch sizes and the backup queue in queue.yaml.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import json
+from datetime import date
+from datetime import datetime
+from datetime import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import ExportChunk
+from models import ExportJob
+from models import ImportChunk
+from models import ImportJob
+
+import seats
+
+KINDS = ('Profile', 'Speaker', 'Conference', 'Session', 'Registration', 'WishlistEntry')
+EXPORT_BATCH = 200  # entities per export chunk
+IMPORT_BATCH = 100  # entities per put_multi on import
+MAX_IMPORT_CHUNK = 1000000  # bytes of NDJSON per uploaded chunk; an ImportChunk must fit in one entity
+BACKUP_QUEUE = 'backup'
+
+
+# - - - - - - - - - - Records - - - - - - - - - - - - - - - - - - -
+
+def _encode(value):
+    """Make a property value JSON serializable."""
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, ndb.Key):
+        return {'__key__': list(value.flat())}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, date):
+        return {'__date__': value.strftime('%Y-%m-%d')}
+    if isinstance(value, time):
+        return {'__time__': value.strftime('%H:%M:%S.%f')}
+    return value
+
+
+def _decode(value):
+    """Reverse _encode."""
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if '__key__' in value:
+            return _key(value['__key__'])
+        if '__datetime__' in value:
+            return datetime.strptime(value['__datetime__'], '%Y-%m-%dT%H:%M:%S.%f')
+        if '__date__' in value:
+            return datetime.strptime(value['__date__'], '%Y-%m-%d').date()
+        if '__time__' in value:
+            return datetime.strptime(value['__time__'], '%H:%M:%S.%f').time()
+    return value
+
+
+def _key(flat):
+    """Build a key of this application from a kind/id path."""
+    return ndb.Key(flat=[str(part) if i % 2 == 0 else part for i, part in enumerate(flat)])
+
+
+def toRecord(entity):
+    """Return the NDJSON record (a dict) of an entity; computed properties are left out."""
+    properties = {}
+    for prop in entity._properties.values():
+        if not isinstance(prop, ndb.ComputedProperty):
+            properties[prop._code_name] = _encode(getattr(entity, prop._code_name))
+    return {'kind': entity._get_kind(), 'key': list(entity.key.flat()), 'properties': properties}
+
+
+def fromRecord(record):
+    """Return the (unsaved) entity of an NDJSON record."""
+    model = ndb.Model._lookup_model(str(record['kind']))
+    properties = dict((str(name), _decode(value)) for name, value in record['properties'].items())
+    return model(key=_key(record['key']), **properties)
+
+
+# - - - - - - - - - - Export - - - - - - - - - - - - - - - - - - -
+
+def startExport(kinds=KINDS):
+    """Create an ExportJob and queue its first chunk; returns the job."""
+    job = ExportJob(kinds=list(kinds))
+    job.put()
+    _queueExport(job.key, 0)
+    return job
+
+
+def _queueExport(job_key, chunk):
+    try:
+        # named, so a retried task cannot chain the same chunk twice
+        taskqueue.add(params={'job': job_key.id(), 'chunk': chunk}, url='/tasks/export',
+                      queue_name=BACKUP_QUEUE, name='export-%d-%d' % (job_key.id(), chunk))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def exportChunk(job_id, chunk):
+    """Export chunk number chunk of the job and queue the next; used by the export task."""
+    job_key = ndb.Key(ExportJob, job_id)
+    job = job_key.get()
+    if not job or job.done or job.chunks != chunk:
+        # finished, or this chunk was committed by an earlier run of the task
+        return
+
+    kind = job.kinds[job.kindIndex]
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    entities, next_cursor, more = ndb.Query(kind=kind).fetch_page(EXPORT_BATCH, start_cursor=cursor)
+    records = [toRecord(entity) for entity in entities]
+    if kind == 'Conference':
+        # sharded seat counts are only approximate on the Conference itself
+        available = seats.getSeatsAvailable(entities)
+        for entity, record in zip(entities, records):
+            record['properties']['seatsAvailable'] = available[entity.key]
+
+    payload = ''.join(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n' for record in records)
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    if _commitExportChunk(job_key, chunk, kind, payload, len(records), next_cursor):
+        _queueExport(job_key, chunk + 1)
+
+
+@ndb.transactional()
+def _commitExportChunk(job_key, chunk, kind, payload, count, next_cursor):
+    """Store the chunk and move the job's checkpoint past it; True if there is more to export."""
+    job = job_key.get()
+    if job.chunks != chunk:
+        return False
+    job.chunks += 1
+    job.count += count
+    job.cursor = next_cursor
+    if not next_cursor:
+        job.kindIndex += 1
+        job.done = job.kindIndex >= len(job.kinds)
+    ndb.put_multi([job, ExportChunk(parent=job_key, id=chunk + 1, kind=kind, count=count, payload=payload)])
+    return not job.done
+
+
+def readExportChunk(job_id, chunk):
+    """Return (job, NDJSON payload of chunk number chunk or None)."""
+    job_key = ndb.Key(ExportJob, job_id)
+    job, stored = ndb.get_multi([job_key, ndb.Key(ExportChunk, chunk + 1, parent=job_key)])
+    return job, stored.payload if stored else None
+
+
+# - - - - - - - - - - Import - - - - - - - - - - - - - - - - - - -
+
+def startImport():
+    """Create an ImportJob for chunks to be uploaded to; returns the job."""
+    job = ImportJob()
+    job.put()
+    return job
+
+
+def addImportChunk(job_id, chunk, payload):
+    """Store an uploaded chunk of NDJSON and queue writing it."""
+    job_key = ndb.Key(ImportJob, job_id)
+    stored = ndb.Key(ImportChunk, chunk + 1, parent=job_key).get()
+    if stored and stored.done:
+        return
+    ImportChunk(parent=job_key, id=chunk + 1, payload=payload).put()
+    try:
+        taskqueue.add(params={'job': job_id, 'chunk': chunk}, url='/tasks/import',
+                      queue_name=BACKUP_QUEUE, name='import-%d-%d' % (job_id, chunk))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # uploaded again; the queued or finished task reads the stored chunk
+        pass
+
+
+def importChunk(job_id, chunk):
+    """Write an uploaded chunk in IMPORT_BATCH batches from its checkpoint; used by the import task."""
+    job_key = ndb.Key(ImportJob, job_id)
+    stored = ndb.Key(ImportChunk, chunk + 1, parent=job_key).get()
+    if not stored or stored.done:
+        return
+
+    lines = [line for line in stored.payload.splitlines() if line.strip()]
+    for start in range(stored.linesDone, len(lines), IMPORT_BATCH):
+        entities = [fromRecord(json.loads(line)) for line in lines[start:start + IMPORT_BATCH]]
+        _reserveIds(entities)
+        shards = []
+        for entity in entities:
+            if entity.key.kind() == 'Conference' and entity.seatShards:
+                shards.extend(seats.createShards(entity.key, entity.seatsAvailable, entity.seatShards))
+        ndb.put_multi(entities + shards)
+        stored.linesDone = min(start + IMPORT_BATCH, len(lines))
+        stored.put()
+
+    _countImportChunk(stored.key, len(lines))
+
+
+@ndb.transactional()
+def _countImportChunk(chunk_key, count):
+    """Mark the chunk done and add it to the job's counts, once; both sit in the job's group."""
+    stored, job = ndb.get_multi([chunk_key, chunk_key.parent()])
+    if stored.done:
+        # counted by an earlier run of the task
+        return
+    stored.done = True
+    job.chunks += 1
+    job.count += count
+    ndb.put_multi([stored, job])
+
+
+def _reserveIds(entities):
+    """Keep allocate_ids from handing out imported numeric ids again."""
+    highest = {}
+    for entity in entities:
+        if isinstance(entity.key.id(), (int, long)):
+            group = (type(entity), entity.key.parent())
+            highest[group] = max(highest.get(group, 0), entity.key.id())
+    futures = [model.allocate_ids_async(max=max_id, parent=parent)
+               for (model, parent), max_id in highest.items()]
+    ndb.Future.wait_all(futures)
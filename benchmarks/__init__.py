@@ -0,0 +1,22 @@
+"""
+benchmarks -- performance benchmarks for the conference API
+
+Run from the project root with the App Engine SDK path, e.g.
+    python -m benchmarks.converter_bench ~/google_cloud_sdk
+"""
+
+import os
+import sys
+
+
+def fixSysPath(sdk_path):
+    """Put the App Engine SDK and the project root on sys.path."""
+    # a Google Cloud SDK install keeps App Engine under platform/
+    if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
+        sdk_path = os.path.join(sdk_path, 'platform/google_appengine')
+    sys.path.insert(0, sdk_path)
+
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+converter_bench.py -- micro-benchmark of model to form conversion
+
+Copies lists of entities to their forms with the compiled converters and
+with the reflection based copy they replaced, and prints the timings.
+
+    python -m benchmarks.converter_bench SDK_PATH [--entities N] [--repeat R]
+"""
+
+import optparse
+import sys
+import timeit
+from datetime import date
+from datetime import time
+
+from benchmarks import fixSysPath
+
+
+def legacyCopy(entity, form_class, conversions):
+    """The per-entity reflection copy used before converters were compiled."""
+    form = form_class()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            if field.name in conversions:
+                setattr(form, field.name, conversions[field.name](getattr(entity, field.name)))
+            else:
+                setattr(form, field.name, getattr(entity, field.name))
+        elif field.name == "websafeKey":
+            setattr(form, field.name, entity.key.urlsafe())
+    form.check_initialized()
+    return form
+
+
+def buildEntities(count):
+    """Return count unsaved Conferences, Sessions, Speakers and Profiles with keys."""
+    from google.appengine.ext import ndb
+    from models import Conference, Profile, Session, Speaker
+
+    entities = {'Conference': [], 'Session': [], 'Speaker': [], 'Profile': []}
+    for i in range(count):
+        p_key = ndb.Key(Profile, 'user%d@example.com' % i)
+        c_key = ndb.Key(Conference, i + 1, parent=p_key)
+        s_key = ndb.Key(Speaker, i + 1)
+        entities['Profile'].append(Profile(key=p_key, displayName='User %d' % i,
+                                           mainEmail='user%d@example.com' % i, teeShirtSize='M_M'))
+        entities['Conference'].append(Conference(
+            key=c_key, name='Conference %d' % i, description='About %d' % i,
+            organizerUserId=p_key.id(), organizerDisplayName='User %d' % i,
+            topics=['Web', 'Python'], city='City %d' % (i % 50), startDate=date(2016, 1 + i % 12, 1),
+            month=1 + i % 12, endDate=date(2016, 1 + i % 12, 3), maxAttendees=100, seatsAvailable=50))
+        entities['Session'].append(Session(
+            key=ndb.Key(Session, 1, parent=c_key), name='Session %d' % i, conferenceKey=c_key,
+            highlights=['one', 'two'], speakerKey=s_key, duration='1', typeOfSession='lecture',
+            date=date(2016, 1, 1), startTime=time(9, 30)))
+        entities['Speaker'].append(Speaker(key=s_key, name='Speaker %d' % i, bio='Bio %d' % i,
+                                           credentials=['PhD'], title='Dr', email='speaker%d@example.com' % i))
+    return entities
+
+
+def main(count, repeat):
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.setup_env(app_id='converter-bench')
+    tb.activate()
+
+    import conference
+    from models import ConferenceForm, ProfileForm, SessionOutForm, SpeakerForm, TeeShirtSize
+
+    entities = buildEntities(count)
+    cases = [
+        ('Conference', conference.copyConferenceToForm,
+         lambda e: legacyCopy(e, ConferenceForm, {'startDate': str, 'endDate': str})),
+        ('Session', conference.copySessionToForm,
+         lambda e: legacyCopy(e, SessionOutForm, {'date': str, 'startTime': str})),
+        ('Speaker', conference.copySpeakerToForm,
+         lambda e: legacyCopy(e, SpeakerForm, {})),
+        ('Profile', conference.copyProfileToForm,
+         lambda e: legacyCopy(e, ProfileForm, {'teeShirtSize': lambda v: getattr(TeeShirtSize, v)})),
+    ]
+
+    print '%-12s %10s %12s %12s %8s' % ('kind', 'entities', 'legacy (s)', 'compiled (s)', 'speedup')
+    for kind, compiled, legacy in cases:
+        items = entities[kind]
+        legacy_time = min(timeit.repeat(lambda: [legacy(e) for e in items], number=1, repeat=repeat))
+        compiled_time = min(timeit.repeat(lambda: [compiled(e) for e in items], number=1, repeat=repeat))
+        print '%-12s %10d %12.4f %12.4f %7.1fx' % (kind, count, legacy_time, compiled_time,
+                                                   legacy_time / compiled_time)
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser('%prog SDK_PATH [options]')
+    parser.add_option('--entities', type='int', default=10000, help='entities per kind')
+    parser.add_option('--repeat', type='int', default=5, help='best of this many runs')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    fixSysPath(args[0])
+    main(options.entities, options.repeat)
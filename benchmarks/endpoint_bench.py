@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+"""
+endpoint_bench.py -- benchmark of every ConferenceApi endpoint
+
+Boots the ConferenceApi api_server on testbed stubs, seeds a deterministic
+synthetic dataset and calls every endpoint, reporting p50/p95/p99 latency,
+datastore/memcache/taskqueue/urlfetch RPCs and response bytes per call as
+JSON. With --baseline the run is compared against an earlier JSON report
+and exits non-zero on a regression, so CI can keep a stored baseline.
+
+    python -m benchmarks.endpoint_bench SDK_PATH [--scale N] [--calls N]
+        [--seed N] [--output FILE] [--baseline FILE] [--tolerance F]
+"""
+
+import json
+import optparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date
+from datetime import time as dtime
+
+from benchmarks import fixSysPath
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPI_PATH = '/_ah/spi/ConferenceApi.%s'
+AUTH_DOMAIN = 'example.com'
+
+# profiles, speakers and conferences per unit of --scale; the rest per parent entity
+SCALE = {
+    'profiles': 50,
+    'speakers': 20,
+    'conferences': 20,
+    'sessionsPerConference': 10,
+    'registrationsPerProfile': 3,
+    'wishlistPerProfile': 5,
+}
+
+CITIES = ['London', 'Paris', 'Berlin', 'Chicago', 'Tokyo', 'Sydney', 'Denver', 'Lima']
+TOPICS = ['Web', 'Python', 'Cloud', 'Mobile', 'Data', 'Security']
+SESSION_TYPES = ['lecture', 'workshop', 'presentation', 'roundtable', 'panel', 'other']
+
+
+# - - - - - - - - - - RPC accounting - - - - - - - - - - - - - - - -
+
+class RpcCounter(object):
+    """Counts API proxy calls per service.method through a pre-call hook."""
+    SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'urlfetch')
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('endpoint_bench', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if service in self.SERVICES:
+            self.counts['%s.%s' % (service, call)] += 1
+
+    def take(self):
+        counts, self.counts = dict(self.counts), defaultdict(int)
+        return counts
+
+
+# - - - - - - - - - - Dataset - - - - - - - - - - - - - - - - - - -
+
+class Dataset(object):
+    """Deterministic synthetic conferences, sessions, speakers and profiles."""
+
+    def __init__(self, scale, seed):
+        self.rng = random.Random(seed)
+        self.scale = scale
+        self.profiles = []
+        self.speakers = []
+        self.conferences = []
+        self.sessions = []
+        self.highDemand = None
+
+    def seed(self):
+        from google.appengine.ext import ndb
+        from conference import ConferenceApi
+        from models import Conference, Profile, Registration, Session, Speaker, WishlistEntry
+        import search
+        import seats
+
+        rng = self.rng
+        count = dict((name, SCALE[name] * self.scale) for name in ('profiles', 'speakers', 'conferences'))
+
+        profiles = [Profile(key=ndb.Key(Profile, 'user%d@%s' % (i, AUTH_DOMAIN)),
+                            displayName='User %d' % i, mainEmail='user%d@%s' % (i, AUTH_DOMAIN),
+                            teeShirtSize='NOT_SPECIFIED')
+                    for i in range(count['profiles'])]
+        speakers = [Speaker(key=ndb.Key(Speaker, i + 1), name='Speaker %d' % i,
+                            bio=' '.join(rng.choice(TOPICS) for _ in range(40)),
+                            credentials=['PhD'], title='Dr', email='speaker%d@%s' % (i, AUTH_DOMAIN))
+                    for i in range(count['speakers'])]
+
+        conferences, shards, sessions = [], [], []
+        for i in range(count['conferences']):
+            organizer = profiles[i % len(profiles)]
+            start = date(2017, 1 + rng.randrange(12), 1 + rng.randrange(28))
+            seats_total = rng.choice([10, 50, 200, 1000])
+            c_key = ndb.Key(Conference, i + 1, parent=organizer.key)
+            conferences.append(Conference(
+                key=c_key, name='Conference %d' % i, description='About conference %d' % i,
+                organizerUserId=organizer.key.id(), organizerDisplayName=organizer.displayName,
+                topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES), startDate=start, month=start.month,
+                endDate=start, maxAttendees=seats_total, seatsAvailable=seats_total,
+                seatShards=seats.SEAT_SHARDS, highDemand=(i == 0)))
+            shards.extend(seats.createShards(c_key, seats_total))
+            for j in range(SCALE['sessionsPerConference']):
+                sessions.append(Session(
+                    key=ndb.Key(Session, j + 1, parent=c_key), name='Session %d.%d' % (i, j),
+                    conferenceKey=c_key, highlights=['intro', 'demo'],
+                    speakerKey=rng.choice(speakers).key, duration='1',
+                    typeOfSession=rng.choice(SESSION_TYPES), date=start,
+                    startTime=dtime(8 + rng.randrange(10), rng.choice([0, 30]))))
+
+        members = []
+        for prof in profiles:
+            members.extend(Registration(key=ConferenceApi._memberKey(Registration, prof.key, conf.key),
+                                        conferenceKey=conf.key)
+                           for conf in rng.sample(conferences, min(SCALE['registrationsPerProfile'],
+                                                                   len(conferences))))
+            members.extend(WishlistEntry(key=ConferenceApi._memberKey(WishlistEntry, prof.key, sess.key),
+                                         sessionKey=sess.key)
+                           for sess in rng.sample(sessions, min(SCALE['wishlistPerProfile'], len(sessions))))
+
+        ndb.put_multi(profiles + speakers + conferences + shards + sessions + members)
+        search.index(speakers + conferences + sessions)
+        self.profiles = [prof.key for prof in profiles]
+        self.speakers = [speaker.key for speaker in speakers]
+        self.conferences = [conf.key for conf in conferences]
+        self.sessions = [sess.key for sess in sessions]
+        self.highDemand = conferences[0].key
+
+
+# - - - - - - - - - - Scenarios - - - - - - - - - - - - - - - - - -
+
+def _user(data):
+    return data.rng.choice(data.profiles).id()
+
+
+def _organizer(data, c_key):
+    return c_key.parent().id()
+
+
+def scenarios(data):
+    """Return (endpoint, user email or None, request body) generators per endpoint.
+
+    Every generator yields one call; stateful pairs (register/unregister,
+    add/remove wishlist) alternate so the dataset stays in shape.
+    """
+    rng = data.rng
+    state = {'tickets': [], 'etags': {}}
+
+    def notModified(name):
+        # revalidate a copy an earlier call of the endpoint returned
+        def call():
+            etags = state['etags'].get(name)
+            if not etags:
+                return None
+            websafeKey, etag = rng.choice(sorted(etags.items()))
+            return None, {'websafeKey': websafeKey, 'ifNoneMatch': etag}
+        return call
+
+    def conferenceQuery():
+        filters = []
+        if rng.random() < 0.5:
+            filters.append({'field': 'CITY', 'operator': 'EQ', 'value': rng.choice(CITIES)})
+        return None, {'filters': filters, 'pageSize': 50}
+
+    def conferenceGetCreated():
+        return rng.choice(data.conferences).parent().id(), {}
+
+    def conferenceGet():
+        return None, {'websafeKey': rng.choice(data.conferences).urlsafe()}
+
+    def conferenceCreate():
+        return _user(data), {'name': 'New %d' % rng.randrange(10 ** 6), 'city': rng.choice(CITIES),
+                             'topics': rng.sample(TOPICS, 2), 'maxAttendees': 100,
+                             'startDate': '2017-06-01', 'endDate': '2017-06-02'}
+
+    def conferenceCreateBatch():
+        return _user(data), {'items': [{'name': 'Batch %d' % rng.randrange(10 ** 6), 'city': rng.choice(CITIES),
+                                        'maxAttendees': 100, 'startDate': '2017-06-01'} for _ in range(20)]}
+
+    def conferenceUpdate():
+        c_key = rng.choice(data.conferences)
+        return _organizer(data, c_key), {'websafeKey': c_key.urlsafe(), 'name': 'Conference',
+                                         'description': 'Updated %d' % rng.randrange(10 ** 6)}
+
+    def announcementGet():
+        return None, {}
+
+    def conferenceGetToAttend():
+        return _user(data), {}
+
+    def conferenceRegisterFor():
+        user = _user(data)
+        c_key = rng.choice(data.conferences[1:] or data.conferences)
+        state['registered'] = (user, c_key)
+        return user, {'websafeKey': c_key.urlsafe()}
+
+    def conferenceUnregisterFrom():
+        user, c_key = state.pop('registered', (_user(data), rng.choice(data.conferences)))
+        return user, {'websafeKey': c_key.urlsafe()}
+
+    def conferenceRegisterForHighDemand():
+        user = _user(data)
+        state['ticketUser'] = user
+        return user, {'websafeKey': data.highDemand.urlsafe()}
+
+    def conferenceGetRegistrationTicket():
+        if not state['tickets']:
+            return None
+        user, ticket = state['tickets'].pop()
+        return user, {'websafeKey': ticket}
+
+    def profileGet():
+        return _user(data), {}
+
+    def profileSave():
+        return _user(data), {'teeShirtSize': rng.choice(['M_M', 'L_W', 'XL_M'])}
+
+    def sessionGetByConferenceByType():
+        return None, {'websafeKey': rng.choice(data.conferences).urlsafe(), 'type': rng.choice(SESSION_TYPES)}
+
+    def sessionGetByConference():
+        return None, {'websafeKey': rng.choice(data.conferences).urlsafe()}
+
+    def sessionGetByConferenceCompact():
+        return None, {'websafeKey': rng.choice(data.conferences).urlsafe(), 'compact': True}
+
+    def sessionGetBySpeaker():
+        return None, {'websafeKey': rng.choice(data.speakers).urlsafe()}
+
+    def sessionCreate():
+        c_key = rng.choice(data.conferences)
+        return _organizer(data, c_key), {
+            'name': 'New session %d' % rng.randrange(10 ** 6), 'websafeConferenceKey': c_key.urlsafe(),
+            'websafeSpeakerKey': rng.choice(data.speakers).urlsafe(), 'typeOfSession': rng.choice(SESSION_TYPES),
+            'date': '2017-06-01', 'startTime': '%02d:00' % (8 + rng.randrange(10))}
+
+    def sessionCreateBatch():
+        c_key = rng.choice(data.conferences)
+        return _organizer(data, c_key), {'items': [
+            {'name': 'Batch session %d' % rng.randrange(10 ** 6), 'websafeConferenceKey': c_key.urlsafe(),
+             'websafeSpeakerKey': rng.choice(data.speakers).urlsafe(), 'typeOfSession': rng.choice(SESSION_TYPES),
+             'date': '2017-06-01', 'startTime': '%02d:00' % (8 + rng.randrange(10))} for _ in range(20)]}
+
+    def sessionsGetFromWishlist():
+        return _user(data), {}
+
+    def sessionsGetFromWishlistCompact():
+        return _user(data), {'compact': True}
+
+    def sessionAddToWishlist():
+        user = _user(data)
+        s_key = rng.choice(data.sessions)
+        state['wished'] = (user, s_key)
+        return user, {'websafeKey': s_key.urlsafe()}
+
+    def sessionDeleteFromWishlist():
+        user, s_key = state.pop('wished', (_user(data), rng.choice(data.sessions)))
+        return user, {'websafeKey': s_key.urlsafe()}
+
+    def sessionGetOfTypes():
+        return None, {'types': rng.sample(SESSION_TYPES, 2), 'pageSize': 50}
+
+    def sessionGetByTime():
+        return None, {'time': '%02d:00' % (8 + rng.randrange(10)), 'pageSize': 50}
+
+    def sessionGetByTimeByNotTypes():
+        return None, {'time': '%02d:00' % (8 + rng.randrange(10)), 'types': rng.sample(SESSION_TYPES, 2),
+                      'pageSize': 50}
+
+    def searchQuery():
+        return None, {'query': '%s %s' % (rng.choice(TOPICS), rng.choice(TOPICS)[:3]), 'pageSize': 20}
+
+    def speakerGetFeatured():
+        return None, {}
+
+    def speakerGetFeaturedByConference():
+        return None, {'websafeKey': rng.choice(data.conferences).urlsafe()}
+
+    def speakerGet():
+        return None, {'websafeKey': rng.choice(data.speakers).urlsafe()}
+
+    def speakerSuggest():
+        return None, {'prefix': 'spe', 'limit': 10}
+
+    def speakerQuery():
+        if rng.random() < 0.5:
+            return None, {'name': 'Speaker %d' % rng.randrange(len(data.speakers))}
+        return None, {'pageSize': 50}
+
+    def speakerCreate():
+        return _user(data), {'name': 'New speaker %d' % rng.randrange(10 ** 6), 'bio': 'Bio',
+                             'email': 'new%d@%s' % (rng.randrange(10 ** 9), AUTH_DOMAIN)}
+
+    def speakerCreateBatch():
+        return _user(data), {'items': [{'name': 'Batch speaker %d' % rng.randrange(10 ** 6), 'bio': 'Bio',
+                                        'email': 'batch%d@%s' % (rng.randrange(10 ** 9), AUTH_DOMAIN)}
+                                       for _ in range(20)]}
+
+    def onResponse(name, user, request, body):
+        # keep queued registration tickets around for the ticket status endpoint
+        if name == 'conferenceRegisterForHighDemand' and body.get('websafeTicketKey'):
+            state['tickets'].append((user, body['websafeTicketKey']))
+        # keep ETags around for the conditional GETs
+        if name in ('conferenceGet', 'speakerGet', 'sessionGetByConference') and body.get('etag'):
+            state['etags'].setdefault(name, {})[request['websafeKey']] = body['etag']
+
+    calls = [
+        ('conferenceQuery', conferenceQuery),
+        ('conferenceGetCreated', conferenceGetCreated),
+        ('conferenceGet', conferenceGet),
+        ('conferenceGetNotModified', notModified('conferenceGet')),
+        ('conferenceCreate', conferenceCreate),
+        ('conferenceCreateBatch', conferenceCreateBatch),
+        ('conferenceUpdate', conferenceUpdate),
+        ('announcementGet', announcementGet),
+        ('conferenceGetToAttend', conferenceGetToAttend),
+        ('conferenceRegisterFor', conferenceRegisterFor),
+        ('conferenceUnregisterFrom', conferenceUnregisterFrom),
+        ('conferenceRegisterForHighDemand', conferenceRegisterForHighDemand),
+        ('conferenceGetRegistrationTicket', conferenceGetRegistrationTicket),
+        ('profileGet', profileGet),
+        ('profileSave', profileSave),
+        ('sessionGetByConferenceByType', sessionGetByConferenceByType),
+        ('sessionGetByConference', sessionGetByConference),
+        ('sessionGetByConferenceNotModified', notModified('sessionGetByConference')),
+        ('sessionGetByConferenceCompact', sessionGetByConferenceCompact),
+        ('sessionGetBySpeaker', sessionGetBySpeaker),
+        ('sessionCreate', sessionCreate),
+        ('sessionCreateBatch', sessionCreateBatch),
+        ('sessionsGetFromWishlist', sessionsGetFromWishlist),
+        ('sessionsGetFromWishlistCompact', sessionsGetFromWishlistCompact),
+        ('sessionAddToWishlist', sessionAddToWishlist),
+        ('sessionDeleteFromWishlist', sessionDeleteFromWishlist),
+        ('sessionGetOfTypes', sessionGetOfTypes),
+        ('sessionGetByTime', sessionGetByTime),
+        ('sessionGetByTimeByNotTypes', sessionGetByTimeByNotTypes),
+        ('searchQuery', searchQuery),
+        ('speakerGetFeatured', speakerGetFeatured),
+        ('speakerGetFeaturedByConference', speakerGetFeaturedByConference),
+        ('speakerGet', speakerGet),
+        ('speakerGetNotModified', notModified('speakerGet')),
+        ('speakerSuggest', speakerSuggest),
+        ('speakerQuery', speakerQuery),
+        ('speakerCreate', speakerCreate),
+        ('speakerCreateBatch', speakerCreateBatch),
+    ]
+    return calls, onResponse
+
+
+# - - - - - - - - - - Running - - - - - - - - - - - - - - - - - - -
+
+# scenarios that call an endpoint under a different name
+ENDPOINT_OF = {
+    'conferenceRegisterForHighDemand': 'conferenceRegisterFor',
+    'conferenceGetNotModified': 'conferenceGet',
+    'sessionGetByConferenceNotModified': 'sessionGetByConference',
+    'sessionGetByConferenceCompact': 'sessionGetByConference',
+    'sessionsGetFromWishlistCompact': 'sessionsGetFromWishlist',
+    'speakerGetNotModified': 'speakerGet',
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def callEndpoint(app, method, user, body):
+    """POST body to the SPI method as user (None for anonymous); returns the response."""
+    import webob
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = user or ''
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = AUTH_DOMAIN if user else ''
+    request = webob.Request.blank(SPI_PATH % method, method='POST', body=json.dumps(body),
+                                  content_type='application/json')
+    return request.get_response(app)
+
+
+def run(scale, calls_per_endpoint, seed):
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id='endpoint-bench', overwrite=True)
+    tb.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=PROJECT_ROOT)
+    tb.init_urlfetch_stub()
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_user_stub()
+
+    import conference
+    import metrics
+    # sampled stats flushes would land in the measured RPCs
+    metrics.SAMPLE_RATE = 0
+
+    data = Dataset(scale, seed)
+    data.seed()
+    counter = RpcCounter()
+    counter.install()
+    calls, onResponse = scenarios(data)
+
+    results = {}
+    for name, scenario in calls:
+        endpoint = ENDPOINT_OF.get(name, name)
+        latencies, sizes, errors, not_modified = [], [], 0, 0
+        rpcs = defaultdict(int)
+        for i in range(calls_per_endpoint):
+            call = scenario()
+            if call is None:
+                continue
+            user, body = call
+            counter.take()
+            started = time.time()
+            response = callEndpoint(conference.api, endpoint, user, body)
+            latencies.append((time.time() - started) * 1000)
+            for rpc, count in counter.take().items():
+                rpcs[rpc] += count
+            sizes.append(len(response.body))
+            if response.status_int == 304:
+                not_modified += 1
+            elif response.status_int >= 300:
+                errors += 1
+            else:
+                onResponse(name, user, body, json.loads(response.body or '{}'))
+
+        if not latencies:
+            continue
+        results[name] = {
+            'calls': len(latencies),
+            'errors': errors,
+            'not_modified': not_modified,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'rpcs_per_call': dict((rpc, round(float(count) / len(latencies), 2)) for rpc, count in rpcs.items()),
+            'bytes_per_call': int(sum(sizes) / len(sizes)),
+        }
+
+    tb.deactivate()
+    return {'scale': scale, 'seed': seed, 'callsPerEndpoint': calls_per_endpoint, 'endpoints': results}
+
+
+def compare(report, baseline, tolerance):
+    """Return regressions of report against baseline: latency p95 beyond tolerance,
+    more RPCs per call, more bytes per call, new errors or fewer 304s."""
+    regressions = []
+    for name, old in baseline.get('endpoints', {}).items():
+        new = report['endpoints'].get(name)
+        if new is None:
+            regressions.append('%s: missing from this run' % name)
+            continue
+        if new['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.1fms > baseline %.1fms' % (name, new['p95_ms'], old['p95_ms']))
+        for rpc, count in new['rpcs_per_call'].items():
+            if count > old['rpcs_per_call'].get(rpc, 0) * (1 + tolerance):
+                regressions.append('%s: %s %.2f/call > baseline %.2f/call' % (
+                    name, rpc, count, old['rpcs_per_call'].get(rpc, 0)))
+        if new['bytes_per_call'] > old['bytes_per_call'] * (1 + tolerance):
+            regressions.append('%s: %d bytes/call > baseline %d bytes/call' % (
+                name, new['bytes_per_call'], old['bytes_per_call']))
+        if new['errors'] > old['errors']:
+            regressions.append('%s: %d errors > baseline %d' % (name, new['errors'], old['errors']))
+        if new['not_modified'] < old.get('not_modified', 0):
+            regressions.append('%s: %d not modified < baseline %d' % (
+                name, new['not_modified'], old['not_modified']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser('%prog SDK_PATH [options]')
+    parser.add_option('--scale', type='int', default=1, help='dataset scale factor')
+    parser.add_option('--calls', type='int', default=50, help='calls per endpoint')
+    parser.add_option('--seed', type='int', default=1, help='random seed for dataset and calls')
+    parser.add_option('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_option('--baseline', help='JSON report to compare against')
+    parser.add_option('--tolerance', type='float', default=0.25, help='allowed relative regression')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    fixSysPath(args[0])
+
+    report = run(options.scale, options.calls, options.seed)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(report, json.load(f), options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION %s' % regression
+        sys.exit(1 if regressions else 0)
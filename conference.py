@@ -7,18 +7,35 @@ conference.py -- Udacity conference server-side Python App Engine API;
 
 __author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
 
+import base64
+import calendar
+import hashlib
+import heapq
+import json
+import logging
+import time
+from collections import OrderedDict
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
+from protorpc import protobuf
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import NotModifiedException
+from models import MEMCACHE_ETAG_PREFIX
+from models import ETAG_LOCK
+from models import BatchResultForm
+from models import BatchResultForms
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
@@ -30,13 +47,24 @@ from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
+from models import NearlySoldOut
+from models import Registration
+from models import RegistrationTicket
+from models import WishlistEntry
+from models import RegistrationStatus
+from models import RegistrationForm
 from models import Session
+from models import Agenda
 from models import SessionInForm
+from models import SessionInForms
 from models import SessionOutForm
 from models import SessionForms
 from models import Speaker
 from models import SpeakerForm
 from models import SpeakerForms
+from models import SpeakerSessions
+from models import SearchResultForm
+from models import SearchResultForms
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -45,13 +73,45 @@ from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
 
+import converters
+import mailer
+import metrics
+import search
+import seats
+import suggest
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+NEARLY_SOLD_OUT_ID = 'nearly-sold-out'
+NEARLY_SOLD_OUT_SEATS = 5
+SEAT_CHECK_WINDOW = 2  # seconds
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 FEATURED_SPEAKER_STR = '%s is speaking at: '
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_MERGED_QUERIES = 30  # same limit the datastore puts on IN filters
+REBALANCE_WINDOW = 10  # seconds
+ORGANIZER_NAME_WINDOW = 10  # seconds
+ORGANIZER_NAME_BATCH = 100
+REGISTRATION_QUEUE = 'registrations'
+REGISTRATION_DRAIN_QUEUE = 'registration-drain'
+REGISTRATION_WINDOW = 2  # seconds
+REGISTRATION_LEASE = 60  # seconds
+REGISTRATION_BATCH = 100
+REGISTRATION_BATCHES_PER_RUN = 10
+SESSION_SUMMARY_WINDOW = 60  # seconds
+AGENDA_ID = 'agenda'
+AGENDA_WINDOW = 5  # seconds
+MEMCACHE_AGENDA_PREFIX = 'AGENDA:'
+REINDEX_BATCH = 100
+MIGRATION_BATCH = 200  # Registration/WishlistEntry entities written per migration transaction
+MIGRATION_PROFILES = 100  # Profiles looked at per migration task
+MAX_BATCH_SIZE = 200  # forms per batch create
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -60,6 +120,7 @@ DEFAULTS = {
     "maxAttendees": 0,
     "seatsAvailable": 0,
     "topics": ["Default", "Topic"],
+    "highDemand": False,
 }
 
 SESSION_DEFAULTS = {
@@ -95,6 +156,28 @@ FIELDS = {
     'MAX_ATTENDEES': 'maxAttendees',
 }
 
+# - - - - - - Form converters - - - - - - - -
+
+# compiled once here; forms are checked when endpoints encodes the response
+copyConferenceToForm = converters.compileConverter(Conference, ConferenceForm, sources={'websafeKey': 'key'})
+copyProfileToForm = converters.compileConverter(Profile, ProfileForm)
+copySessionToForm = converters.compileConverter(Session, SessionOutForm, sources={
+    'websafeKey': 'key',
+    'websafeConferenceKey': 'conferenceKey',
+    'websafeSpeakerKey': 'speakerKey',
+})
+# SessionOutForm field -> Speaker property (and SpeakerForm field) it repeats
+SPEAKER_SESSION_FIELDS = {
+    'speakerName': 'name',
+    'speakerBio': 'bio',
+    'speakerCredentials': 'credentials',
+    'speakerTitle': 'title',
+    'speakerEmail': 'email',
+}
+copySpeakerToSessionForm = converters.compileConverter(Speaker, SessionOutForm, sources=SPEAKER_SESSION_FIELDS,
+                                                       fields=tuple(SPEAKER_SESSION_FIELDS))
+copySpeakerToForm = converters.compileConverter(Speaker, SpeakerForm, sources={'websafeKey': 'key'})
+
 # - - - - - - Request Containers - - - - - - - -
 
 # Containers names do not necessarily restrict their usage to conference functions
@@ -107,30 +190,95 @@ CONF_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeKey=messages.StringField(1, required=True),
     type=messages.StringField(2),
+    compact=messages.BooleanField(3),
 )
 
 CONF_GET_BY_TIME_TYPES_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     time=messages.StringField(1),
     types=messages.StringField(2, repeated=True),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
+    compact=messages.BooleanField(5),
 )
 
 CONF_GET_BY_TIME_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     time=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    compact=messages.BooleanField(4),
 )
 
 CONF_GET_BY_TYPES_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     types=messages.StringField(1, repeated=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    compact=messages.BooleanField(4),
 )
 
 SPEAKER_GET_BY = endpoints.ResourceContainer(
     message_types.VoidMessage,
     name=messages.StringField(1),
     email=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
+)
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+)
+
+ETAG_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeKey=messages.StringField(1, required=True),
+    ifNoneMatch=messages.StringField(2),  # etag of the copy the client has
 )
 
+# compact: list each speaker once in SessionForms.speakers instead of in every session
+SESSION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeKey=messages.StringField(1, required=True),
+    ifNoneMatch=messages.StringField(2),  # sessionGetByConference only
+    compact=messages.BooleanField(3),
+)
+
+WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    compact=messages.BooleanField(1),
+)
+
+SPEAKER_SUGGEST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1, required=True),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, required=True),
+    kinds=messages.StringField(2, repeated=True),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
+)
+
+# - - - - - - - - - - Request Context - - - - - - - - - - - - - - - -
+
+class RequestContext(object):
+    """Per-request memo of the current user, their id and their Profile.
+
+    ConferenceApi helpers share it so a request checks authorization and
+    loads the Profile at most once, however many helpers need them.
+    """
+
+    def __init__(self):
+        self.user = None
+        self.user_id = None
+        self.profile = None
+
 # - - - - - - - - - - Endpoints Start - - - - - - - - - - - - - - - -
 
 @endpoints.api(name='conference', version='v1', audiences=[ANDROID_AUDIENCE],
@@ -162,48 +310,198 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException(
                 'No websafe key was received with request.')
 
+    def _parseKey(self, websafeKey):
+        """Return the ndb Key of a websafe key, None if there is none or it is malformed."""
+        try:
+            return ndb.Key(urlsafe=websafeKey.strip()) if websafeKey else None
+        except Exception:
+            # same vague except as _validateKey; multiple types of error.
+            return None
+
+    def _prefetched(self, entities, websafeKey, kind):
+        """Return the entity of kind for a websafe key from a batch of key -> entity."""
+        if not websafeKey:
+            raise endpoints.BadRequestException('No websafe key was received with request.')
+        key = self._parseKey(websafeKey)
+        if key is None:
+            raise endpoints.BadRequestException('The key is of an incorrect format: %s' % websafeKey)
+        if key.kind() != kind or not entities.get(key):
+            raise endpoints.NotFoundException('No %s found with key: %s' % (kind.lower(), websafeKey))
+        return entities[key]
+
+    def _checkBatchSize(self, items):
+        """Reject empty batches and batches over MAX_BATCH_SIZE items."""
+        if not items:
+            raise endpoints.BadRequestException('No items were received with request.')
+        if len(items) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException('At most %d items can be created at once.' % MAX_BATCH_SIZE)
+
+    def _batchResults(self, items, prepare):
+        """Run prepare on every item of a batch; returns a BatchResultForm per item and
+        the (index, prepared value) pairs of the items it accepted. An item prepare
+        rejects gets the error on its result instead of failing the batch."""
+        results, valid = [], []
+        for i, item in enumerate(items):
+            results.append(BatchResultForm(index=i))
+            try:
+                valid.append((i, prepare(item)))
+            except (endpoints.ServiceException, ValueError, datastore_errors.BadValueError) as e:
+                results[i].error = str(e)
+        return results, valid
+
+    def _ifNoneMatch(self, request, stamp, variant=''):
+        """Return the ETag the client has (ifNoneMatch or the If-None-Match header);
+        raises NotModifiedException if it is the one stamp was last served with
+        (plus variant, which tells apart representations of the same version)."""
+        etag = request.ifNoneMatch
+        if not etag:
+            headers = getattr(self.request_state, 'headers', None)
+            etag = headers.get('If-None-Match') if headers else None
+        if not etag:
+            return None
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etag = etag.strip('"')
+        current = memcache.get(MEMCACHE_ETAG_PREFIX + stamp) if stamp else None
+        if current and current + variant == etag:
+            raise NotModifiedException()
+        return etag
+
+    @staticmethod
+    def _checkETag(stamp, etag, client_etag, variant=''):
+        """Remember etag as the one stamp is served with; raises NotModifiedException
+        if the client has it (plus variant) already, else returns it."""
+        # add, not set: a write since the data was read has locked the stamp
+        memcache.add(MEMCACHE_ETAG_PREFIX + stamp, etag)
+        etag += variant
+        if etag == client_etag:
+            raise NotModifiedException()
+        return etag
+
+    @staticmethod
+    def _etagsChanged(stamps):
+        """Drop the stamps of changed data, locking out readers of the old data for ETAG_LOCK."""
+        memcache.delete_multi(stamps, seconds=ETAG_LOCK, key_prefix=MEMCACHE_ETAG_PREFIX)
+
+    def _pageSize(self, request):
+        """Return the page size requested, falling back to the default and capped."""
+        if request.pageSize and request.pageSize > 0:
+            return min(request.pageSize, MAX_PAGE_SIZE)
+        return DEFAULT_PAGE_SIZE
+
+    def _fetchPage(self, query, request):
+        """Fetch the page of query results requested by pageSize/pageToken;
+        returns the entities and the token of the next page (None on the last page)."""
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) if request.pageToken else None
+            results, next_cursor, more = query.fetch_page(self._pageSize(request), start_cursor=cursor)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException('Invalid page token: %s' % request.pageToken)
+        return results, next_cursor.urlsafe() if more and next_cursor else None
+
+    def _fetchMergedPage(self, queries, sort_key, request):
+        """Fetch one page of the ordered union of several queries.
+
+        Every query must be ordered consistently with sort_key. The query streams are
+        merged with a heap and the page token keeps one cursor per query, so pages
+        stay stable where the datastore cannot page an IN query by itself. No query
+        reads more than one page (plus one look-ahead entity) per request.
+        """
+        if len(queries) > MAX_MERGED_QUERIES:
+            raise endpoints.BadRequestException('At most %d values can be given.' % MAX_MERGED_QUERIES)
+        page_size = self._pageSize(request)
+
+        # one cursor per query; None means from the start, '' means exhausted
+        cursors = [None] * len(queries)
+        if request.pageToken:
+            try:
+                cursors = json.loads(base64.urlsafe_b64decode(str(request.pageToken)))
+                if not isinstance(cursors, list) or len(cursors) != len(queries):
+                    raise ValueError('Cursor count does not match query count')
+                start_cursors = [Cursor(urlsafe=c) if c else None for c in cursors]
+            except (TypeError, ValueError, datastore_errors.BadValueError):
+                raise endpoints.BadRequestException('Invalid page token: %s' % request.pageToken)
+        else:
+            start_cursors = cursors
+
+        # start every query before consuming any so their RPCs overlap
+        iterators = [query.iter(start_cursor=cursor, produce_cursors=True,
+                                limit=page_size + 1, batch_size=page_size + 1)
+                     if cursors[i] != '' else None
+                     for i, (query, cursor) in enumerate(zip(queries, start_cursors))]
+
+        heap = []
+
+        def push(i):
+            it = iterators[i]
+            if it.has_next():
+                entity = it.next()
+                heapq.heappush(heap, (sort_key(entity), i, entity, it.cursor_after()))
+            else:
+                cursors[i] = ''
+
+        try:
+            for i, it in enumerate(iterators):
+                if it:
+                    push(i)
+
+            results = []
+            while heap and len(results) < page_size:
+                key, i, entity, cursor = heapq.heappop(heap)
+                results.append(entity)
+                cursors[i] = cursor.urlsafe()
+                push(i)
+        except datastore_errors.BadRequestError:
+            raise endpoints.BadRequestException('Invalid page token: %s' % request.pageToken)
+
+        next_page = None
+        if heap:
+            next_page = base64.urlsafe_b64encode(json.dumps(cursors))
+        return results, next_page
+
+    def initialize_request_state(self, request_state):
+        """Start every request with a fresh RequestContext."""
+        super(ConferenceApi, self).initialize_request_state(request_state)
+        self._context = RequestContext()
+
+    def _requestContext(self):
+        """Return the RequestContext of the current request."""
+        if getattr(self, '_context', None) is None:
+            self._context = RequestContext()
+        return self._context
+
     def _validateUser(self):
         """Verifies user authorization and returns user obj and its id"""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        ctx = self._requestContext()
+        # only check authorization once per request
+        if ctx.user is None:
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException('Authorization required')
+            ctx.user_id = getUserId(user)
+            ctx.user = user
 
-        return user, user_id
+        return ctx.user, ctx.user_id
 
     # - - - Conference objects - - - - - - - - - - - - - - - - -
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+        cf = copyConferenceToForm(conf)
+        # sharded conferences pass in the aggregate of their seat shards
+        if seatsAvailable is not None:
+            cf.seatsAvailable = seatsAvailable
         return cf
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-
-        user, user_id = self._validateUser()
-        # this assures that a profile has been created before creating a conf;
-        self._getProfileFromUser()
-
+    def _conferenceData(self, request, prof):
+        """Validate a ConferenceForm and return the Conference fields for it, without the key."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
+        del data['etag']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -223,26 +521,69 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        data['organizerUserId'] = request.organizerUserId = prof.key.id()
+        data['organizerDisplayName'] = request.organizerDisplayName = prof.displayName
+        data['seatShards'] = seats.SEAT_SHARDS
+        return data
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+
+        user, user_id = self._validateUser()
+        # this assures that a profile has been created before creating a conf;
+        prof = self._getProfileFromUser()
+        data = self._conferenceData(request, prof)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        prof = p_key.get()
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
-        data['organizerUserId'] = request.organizerUserId = user_id
-
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(), 'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email')
-        conf = c_key.get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        c_id = Conference.allocate_ids(size=1, parent=prof.key)[0]
+        conf = Conference(key=ndb.Key(Conference, c_id, parent=prof.key), **data)
+        self._putConferences([conf], user.email())
+        return self._copyConferenceToForm(conf)
+
+    def _putConferences(self, confs, email):
+        """Write new conferences and their seat shards in one batch and queue their
+        confirmation email and seat checks."""
+        shards = []
+        for conf in confs:
+            shards.extend(seats.createShards(conf.key, conf.seatsAvailable))
+        ndb.put_multi(confs + shards)
+        search.index(confs)
+
+        # email the organizer confirming creation of the Conferences, in their next digest
+        mailer.queueMail(email, 'You created a new Conference!', self._confirmationText(confs))
+        self._addTasks([self._seatCheckTask(conf.key) for conf in confs
+                        if 0 < conf.seatsAvailable <= NEARLY_SOLD_OUT_SEATS])
+
+    @staticmethod
+    def _confirmationText(confs):
+        """Return the confirmation email body listing new conferences."""
+        lines = []
+        for conf in confs:
+            details = [detail for detail in (conf.city, conf.startDate and str(conf.startDate)) if detail]
+            lines.append('- %s%s' % (conf.name, ' (%s)' % ', '.join(details) if details else ''))
+        return 'Hi, you have created the following conference(s):\r\n\r\n%s' % '\r\n'.join(lines)
+
+    def _createConferenceObjects(self, request):
+        """Create the Conferences of a ConferenceForms; returns a result per form."""
+        user, user_id = self._validateUser()
+        prof = self._getProfileFromUser()
+        self._checkBatchSize(request.items)
+
+        results, valid = self._batchResults(request.items, lambda item: self._conferenceData(item, prof))
+        if valid:
+            # one id allocation for the whole batch
+            first, last = Conference.allocate_ids(size=len(valid), parent=prof.key)
+            confs = []
+            for c_id, (i, data) in zip(range(first, last + 1), valid):
+                confs.append(Conference(key=ndb.Key(Conference, c_id, parent=prof.key), **data))
+                results[i].websafeKey = confs[-1].key.urlsafe()
+            self._putConferences(confs, user.email())
+        return BatchResultForms(items=results)
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-
+        """Update Conference object from ConferenceForm, returning the Conference."""
         user, user_id = self._validateUser()
 
         conf, c_key = self._validateKey(request.websafeKey)
@@ -255,33 +596,104 @@ class ConferenceApi(remote.Service):
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; the organizer's name follows their Profile
+            if data not in (None, []) and field.name not in ('organizerDisplayName', 'etag'):
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
                     if field.name == 'startDate':
                         conf.month = data.month
+                # seats of sharded conferences live in the shards; reset them
+                # once this transaction has committed
+                elif field.name == 'seatsAvailable' and conf.seatShards:
+                    taskqueue.add(params={'websafeConferenceKey': conf.key.urlsafe(), 'seats': data},
+                                  url='/tasks/rebalance_seats', transactional=True)
+                    continue
                 # write to Conference object
                 setattr(conf, field.name, data)
+        conf.version += 1
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return conf
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    def _fillOrganizerNames(self, confs):
+        """Fill in organizerDisplayName on conferences stored before it was denormalized."""
+        missing = set(conf.organizerUserId for conf in confs if conf.organizerDisplayName is None)
+        if not missing:
+            return
+
+        # one deduplicated batch of Profile gets for the organizers still missing
+        profiles = ndb.get_multi([ndb.Key(Profile, user_id) for user_id in missing])
+        names = dict((prof.key.id(), prof.displayName) for prof in profiles if prof)
+        for conf in confs:
+            if conf.organizerDisplayName is None:
+                conf.organizerDisplayName = names.get(conf.organizerUserId)
+
+        # backfill the stored conferences so later reads skip the Profile gets
+        self._queueOrganizerNameUpdates(names.keys())
+
+    @staticmethod
+    def _addTasks(tasks, queue_name='default'):
+        """Add tasks to a queue in as few calls as allowed; named tasks already queued are skipped."""
+        queue = taskqueue.Queue(queue_name)
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            try:
+                queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                # the rest of the batch is still added; those tasks are already queued for their window
+                pass
+
+    @staticmethod
+    def _queueOrganizerNameUpdates(user_ids):
+        """Enqueue copying each organizer's displayName onto their conferences; one per window."""
+        window = int(time.time() // ORGANIZER_NAME_WINDOW)
+        ConferenceApi._addTasks([
+            taskqueue.Task(params={'userId': user_id}, url='/tasks/update_organizer_name',
+                           name='organizer-%s-%d' % (hashlib.md5(user_id.encode('utf-8')).hexdigest(), window))
+            for user_id in user_ids])
+
+    @staticmethod
+    def _updateOrganizerName(request):
+        """Copy an organizer's current displayName onto all of their conferences."""
+        p_key = ndb.Key(Profile, request.get('userId'))
+        prof = p_key.get()
+        if not prof:
+            return
+
+        # conferences are children of the organizer's Profile; walk them in batches
+        query = Conference.query(ancestor=p_key)
+        cursor, more = None, True
+        while more:
+            c_keys, cursor, more = query.fetch_page(ORGANIZER_NAME_BATCH, start_cursor=cursor, keys_only=True)
+            changed = ConferenceApi._setOrganizerName(c_keys, prof.displayName)
+            ConferenceApi._etagsChanged([c_key.urlsafe() for c_key in changed])
+
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerName(c_keys, displayName):
+        """Write displayName onto the conferences that do not have it yet."""
+        confs = [conf for conf in ndb.get_multi(c_keys) if conf and conf.organizerDisplayName != displayName]
+        for conf in confs:
+            conf.organizerDisplayName = displayName
+            conf.version += 1
+        ndb.put_multi(confs)
+        return [conf.key for conf in confs]
+
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
                       path='conference/user',
                       http_method='GET', name='conferenceGetCreated')
     def conferenceGetCreated(self, request):
-        """Return conferences created by user."""
+        """Return conferences created by user, one page at a time."""
         # make sure user is authed
         user, user_id = self._validateUser()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs, next_page = self._fetchPage(Conference.query(ancestor=ndb.Key(Profile, user_id)), request)
+        self._fillOrganizerNames(confs)
+        seats_available = seats.getSeatsAvailable(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, seats_available[conf.key]) for conf in confs],
+            nextPageToken=next_page
         )
 
     @endpoints.method(ConferenceForm, ConferenceForm,
@@ -289,17 +701,35 @@ class ConferenceApi(remote.Service):
                       http_method='PUT', name='conferenceUpdate')
     def conferenceUpdate(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf = self._updateConferenceObject(request)
+        self._etagsChanged([conf.key.urlsafe()])
+        search.index([conf])
+        self._fillOrganizerNames([conf])
+        # the seats or the name in the announcement may have changed
+        self._addTasks([self._seatCheckTask(conf.key)])
+        # a requested seat count is applied by the rebalance task, report it back as-is
+        if request.seatsAvailable is not None:
+            seatsAvailable = request.seatsAvailable
+        else:
+            seatsAvailable = seats.getSeatsAvailable([conf])[conf.key]
+        return self._copyConferenceToForm(conf, seatsAvailable)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(ETAG_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeKey}',
                       http_method='GET', name='conferenceGet')
     def conferenceGet(self, request):
-        """Return requested conference by websafeKey."""
+        """Return requested conference by websafeKey; 304 if ifNoneMatch is still current."""
+        c_key = self._parseKey(request.websafeKey)
+        client_etag = self._ifNoneMatch(request, c_key and c_key.urlsafe())
         conf, c_key = self._validateKey(request.websafeKey)
-        prof = conf.key.parent().get()
+        seats_available = seats.getSeatsAvailable([conf])[c_key]
+        # seats live in the shards, so they are part of the tag
+        etag = self._checkETag(c_key.urlsafe(), 'c%d.%d' % (conf.version, seats_available), client_etag)
+        self._fillOrganizerNames([conf])
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, seats_available)
+        cf.etag = etag
+        return cf
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='conferenceCreate')
@@ -307,29 +737,107 @@ class ConferenceApi(remote.Service):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    @endpoints.method(ConferenceForms, BatchResultForms, path='conference/batch',
+                      http_method='POST', name='conferenceCreateBatch')
+    def conferenceCreateBatch(self, request):
+        """Create many conferences; returns a result per conference, with its key or error."""
+        return self._createConferenceObjects(request)
+
         # - - - Announcements - - - - - - - - - - - - - - - - - - - -
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Reconcile the nearly sold out set & assign Announcement to memcache;
+        used by memcache cron job.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        nearly = NearlySoldOut.get_by_id(NEARLY_SOLD_OUT_ID)
+        if nearly is None:
+            # first run: seed the set from the one full query it replaces
+            c_keys = Conference.query(ndb.AND(
+                Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+                Conference.seatsAvailable > 0)
+            ).fetch(keys_only=True)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            # only the members can have drifted; additions arrive through seat checks
+            c_keys = [ndb.Key(urlsafe=key) for key in nearly.conferences]
+        return ConferenceApi._updateNearlySoldOut(c_keys)
 
+    @staticmethod
+    def _seatCheckTask(c_key):
+        """Return the named task checking a conference against the nearly sold out set; one per window."""
+        return taskqueue.Task(params={'websafeConferenceKey': c_key.urlsafe()},
+                              url='/tasks/check_seats',
+                              name='seats-%s-%d' % (c_key.urlsafe(), time.time() // SEAT_CHECK_WINDOW))
+
+    @staticmethod
+    def _checkSeats(request):
+        """Add or drop a conference from the nearly sold out set; used by the seat check task."""
+        ConferenceApi._updateNearlySoldOut([ndb.Key(urlsafe=request.get('websafeConferenceKey'))])
+
+    @staticmethod
+    def _nearlySoldOutName(conf, available):
+        """Return the conference's name in the nearly sold out set given its seats
+        available, or None if it does not belong there."""
+        if conf and 0 < available <= NEARLY_SOLD_OUT_SEATS:
+            return conf.name
+        return None
+
+    @staticmethod
+    def _updateNearlySoldOut(c_keys):
+        """Put conferences in or out of the nearly sold out set by their current seats;
+        returns the announcement."""
+        confs = ndb.get_multi(c_keys)
+        available = seats.getSeatsAvailable([conf for conf in confs if conf])
+        stored = NearlySoldOut.get_by_id(NEARLY_SOLD_OUT_ID)
+        members = stored.conferences if stored else {}
+        changes = {}
+        for c_key, conf in zip(c_keys, confs):
+            name = ConferenceApi._nearlySoldOutName(conf, available.get(c_key, 0))
+            if members.get(c_key.urlsafe()) != name:
+                changes[c_key.urlsafe()] = name
+        # most checks change nothing; only a change to the membership takes the
+        # transaction on the singleton
+        nearly = stored
+        if changes or stored is None:
+            nearly = ConferenceApi._applyNearlySoldOut(changes)
+        return ConferenceApi._setAnnouncement(nearly)
+
+    @staticmethod
+    @ndb.transactional()
+    def _applyNearlySoldOut(changes):
+        """Apply websafe key -> name (None to drop) changes to the stored set; returns it."""
+        stored = NearlySoldOut.get_by_id(NEARLY_SOLD_OUT_ID)
+        nearly = stored or NearlySoldOut(id=NEARLY_SOLD_OUT_ID)
+        conferences = dict(nearly.conferences)
+        for key, name in changes.items():
+            if name is None:
+                conferences.pop(key, None)
+            else:
+                conferences[key] = name
+        if stored is None or conferences != nearly.conferences:
+            nearly.conferences = conferences
+            nearly.version += 1
+            nearly.put()
+        return nearly
+
+    @staticmethod
+    def _setAnnouncement(nearly):
+        """Write (version, Announcement) to memcache unless a newer version is there; returns it."""
+        announcement = ''
+        if nearly.conferences:
+            announcement = ANNOUNCEMENT_TPL % ', '.join(sorted(nearly.conferences.values()))
+        value = (nearly.version, announcement)
+
+        # concurrent checks commit in version order but may reach memcache out of it
+        client = memcache.Client()
+        for attempt in range(3):
+            cached = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if cached is None:
+                if client.add(MEMCACHE_ANNOUNCEMENTS_KEY, value):
+                    break
+            elif isinstance(cached, tuple) and cached[0] >= nearly.version:
+                break
+            elif client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, value):
+                break
         return announcement
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
@@ -337,21 +845,86 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='announcementGet')
     def announcementGet(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        cached = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if isinstance(cached, tuple):
+            return StringMessage(data=cached[1])
+
+        # evicted: restore it from the stored set
+        nearly = NearlySoldOut.get_by_id(NEARLY_SOLD_OUT_ID)
+        return StringMessage(data=self._setAnnouncement(nearly) if nearly else "")
 
     # - - - Registration - - - - - - - - - - - - - - - - - - - -
-    @ndb.transactional(xg=True)
     def _registerForConference(self, request, reg=True):
         """Register or unregister user for selected conference."""
-
-        retval = None
         prof = self._getProfileFromUser()  # get user Profile
         conf, c_key = self._validateKey(request.websafeKey)
+        retval = self._registerProfile(prof.key, conf, reg)
+        return BooleanMessage(data=retval)
+
+    @staticmethod
+    def _registerProfile(p_key, conf, reg=True, ticket_key=None):
+        """Register or unregister profile for conference, resolving ticket if given."""
+        if not conf.seatShards:
+            retval, seats_left = ConferenceApi._registerUnsharded(p_key, conf.key, reg, ticket_key)
+        elif reg:
+            retval, seats_left = ConferenceApi._registerSharded(p_key, conf, ticket_key)
+        else:
+            retval, seats_left = ConferenceApi._unregisterSharded(p_key, conf)
+
+        # seats_left is None when no seat moved, e.g. for a ticket resolved before
+        if seats_left is None:
+            return retval
+        # a shard holds no more than the total, so only a shard at most one above
+        # the threshold can move the conference in or out of the nearly sold out set
+        if seats_left <= NEARLY_SOLD_OUT_SEATS + 1 and ConferenceApi._nearlySoldOutMoved(conf, seats_left):
+            ConferenceApi._addTasks([ConferenceApi._seatCheckTask(conf.key)])
+        ConferenceApi._etagsChanged([conf.key.urlsafe()])
+        return retval
+
+    @staticmethod
+    def _nearlySoldOutMoved(conf, seats_left):
+        """Return True if the conference's summed seats put it on the other side
+        of the nearly sold out set than it is stored."""
+        if conf.seatShards:
+            seats_left = seats.getSeatsAvailable([conf])[conf.key]
+        nearly = NearlySoldOut.get_by_id(NEARLY_SOLD_OUT_ID)
+        stored = nearly.conferences.get(conf.key.urlsafe()) if nearly else None
+        return (stored is None) != (ConferenceApi._nearlySoldOutName(conf, seats_left) is None)
+
+    @staticmethod
+    def _memberKey(model, p_key, key):
+        """Return the key of the Registration or WishlistEntry of p_key for a Conference or Session key."""
+        # the key path rather than the websafe key, which names the application
+        return ndb.Key(model, '/'.join(str(part) for part in key.flat()), parent=p_key)
+
+    @staticmethod
+    def _memberKeys(model, p_key):
+        """Return the Conference or Session keys of p_key's Registrations or WishlistEntries, oldest first."""
+        entries = sorted(model.query(ancestor=p_key).fetch(), key=lambda entry: entry.created)
+        return [entry.conferenceKey if model is Registration else entry.sessionKey for entry in entries]
+
+    @staticmethod
+    def _resolvedTicket(ticket):
+        """Return True/False if ticket was already resolved by an earlier attempt, else None."""
+        if ticket and ticket.status != str(RegistrationStatus.PENDING):
+            return ticket.status == str(RegistrationStatus.REGISTERED)
+        return None
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _registerUnsharded(p_key, c_key, reg=True, ticket_key=None):
+        """Register or unregister profile, counting seats on the Conference itself;
+        returns (done, seats left, or None if no seat moved)."""
+        r_key = ConferenceApi._memberKey(Registration, p_key, c_key)
+        registration, conf = ndb.get_multi([r_key, c_key])
+        ticket = ticket_key.get() if ticket_key else None
+        if ConferenceApi._resolvedTicket(ticket) is not None:
+            return ConferenceApi._resolvedTicket(ticket), None
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if c_key in prof.conferencesToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -361,26 +934,212 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferencesToAttend.append(c_key)
             conf.seatsAvailable -= 1
-            retval = True
+            entities = [Registration(key=r_key, conferenceKey=c_key), conf]
 
         # unregister
         else:
             # check if user already registered
-            if c_key in prof.conferencesToAttend:
+            if not registration:
+                return False, None
 
-                # unregister user, add back one seat
-                prof.conferencesToAttend.remove(c_key)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+            # unregister user, add back one seat
+            r_key.delete()
+            conf.seatsAvailable += 1
+            entities = [conf]
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        if ticket:
+            ticket.status = str(RegistrationStatus.REGISTERED)
+            entities.append(ticket)
+        ndb.put_multi(entities)
+        return True, conf.seatsAvailable
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _claimSeat(p_key, c_key, shard_key, ticket_key=None):
+        """Take one seat from the shard for the profile; returns (registered, seats
+        left on the shard), or None if it ran dry since it was picked. A ticket
+        resolved before keeps its recorded outcome and takes no seat: (outcome, None)."""
+        r_key = ConferenceApi._memberKey(Registration, p_key, c_key)
+        registration, shard = ndb.get_multi([r_key, shard_key])
+        ticket = ticket_key.get() if ticket_key else None
+        if ConferenceApi._resolvedTicket(ticket) is not None:
+            return ConferenceApi._resolvedTicket(ticket), None
+        if registration:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if shard.seats <= 0:
+            return None
+
+        shard.seats -= 1
+        entities = [Registration(key=r_key, conferenceKey=c_key), shard]
+        if ticket:
+            ticket.status = str(RegistrationStatus.REGISTERED)
+            entities.append(ticket)
+        ndb.put_multi(entities)
+        return True, shard.seats
+
+    @staticmethod
+    def _registerSharded(p_key, conf, ticket_key=None):
+        """Register profile by claiming a seat from a random non-empty shard;
+        returns (registered, seats left on that shard, or None if no seat moved)."""
+        for shard in seats.pickShards(conf):
+            claimed = ConferenceApi._claimSeat(p_key, conf.key, shard.key, ticket_key)
+            if claimed is not None:
+                registered, seats_left = claimed
+                if seats_left == 0:
+                    # this shard is dry; spread what is left over all shards again
+                    ConferenceApi._queueRebalance(conf.key)
+                return registered, seats_left
+
+        # no shard had seats left, unless they are unevenly spread
+        ConferenceApi._queueRebalance(conf.key)
+        raise ConflictException(
+            "There are no seats available.")
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _releaseSeat(p_key, c_key, shard_key):
+        """Give the profile's seat back to the shard; returns the shard's seats,
+        or None if not registered."""
+        r_key = ConferenceApi._memberKey(Registration, p_key, c_key)
+        registration, shard = ndb.get_multi([r_key, shard_key])
+        if not registration:
+            return None
+
+        r_key.delete()
+        shard.seats += 1
+        shard.put()
+        return shard.seats
+
+    @staticmethod
+    def _unregisterSharded(p_key, conf):
+        """Unregister profile, returning the seat to a random shard;
+        returns (unregistered, seats on that shard)."""
+        seats_left = ConferenceApi._releaseSeat(p_key, conf.key, seats.randomShardKey(conf))
+        return seats_left is not None, seats_left
+
+    # - - - Queued registration - - - - - - - - - - - - - - - - -
+    def _copyTicketToForm(self, ticket):
+        """Copy relevant fields from RegistrationTicket to RegistrationForm."""
+        rf = RegistrationForm(
+            websafeTicketKey=ticket.key.urlsafe(),
+            websafeConferenceKey=ticket.conferenceKey.urlsafe(),
+            status=getattr(RegistrationStatus, ticket.status),
+            reason=ticket.reason,
+        )
+        if ticket.status != str(RegistrationStatus.PENDING):
+            rf.data = ticket.status == str(RegistrationStatus.REGISTERED)
+        rf.check_initialized()
+        return rf
+
+    def _queueRegistration(self, prof, conf):
+        """Record a pending registration ticket and queue it for the registration worker."""
+        c_key = conf.key
+        ticket = RegistrationTicket(parent=prof.key, conferenceKey=c_key)
+        ticket.put()
+        try:
+            taskqueue.Queue(REGISTRATION_QUEUE).add(
+                taskqueue.Task(payload=ticket.key.urlsafe(), method='PULL', tag=c_key.urlsafe()))
+        except taskqueue.Error:
+            ticket.key.delete()
+            raise
+        self._queueRegistrationDrain(c_key)
+        return self._copyTicketToForm(ticket)
+
+    @staticmethod
+    def _queueRegistrationDrain(c_key, continuation=False, countdown=0):
+        """Enqueue a drain of the conference's queued registrations; one per window."""
+        if continuation:
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                          url='/tasks/drain_registrations', queue_name=REGISTRATION_DRAIN_QUEUE,
+                          countdown=countdown)
+            return
+        try:
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                          url='/tasks/drain_registrations', queue_name=REGISTRATION_DRAIN_QUEUE,
+                          name='drain-%s-%d' % (c_key.urlsafe(), time.time() // REGISTRATION_WINDOW),
+                          countdown=REGISTRATION_WINDOW)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # a drain for this window is already queued and will pick this ticket up
+            pass
+
+    @staticmethod
+    def _drainRegistrations(request):
+        """Resolve queued registrations for a conference in batches, oldest first."""
+        c_key = ndb.Key(urlsafe=request.get('websafeConferenceKey'))
+        queue = taskqueue.Queue(REGISTRATION_QUEUE)
+        conf = c_key.get()
+
+        for i in range(REGISTRATION_BATCHES_PER_RUN):
+            tasks = queue.lease_tasks_by_tag(REGISTRATION_LEASE, REGISTRATION_BATCH, tag=c_key.urlsafe())
+            if not tasks:
+                return
+            tasks.sort(key=lambda task: task.eta)
+            tickets = ndb.get_multi([ndb.Key(urlsafe=task.payload) for task in tasks])
+            resolved = []
+            for task, ticket in zip(tasks, tickets):
+                if ticket and ticket.status == str(RegistrationStatus.PENDING):
+                    try:
+                        ConferenceApi._resolveTicket(ticket, conf)
+                    except (datastore_errors.TransactionFailedError, datastore_errors.Timeout,
+                            datastore_errors.InternalError) as e:
+                        # leave the task leased; it is leased again once the lease lapses
+                        logging.warning('Registration ticket %s not resolved: %s', ticket.key.urlsafe(), e)
+                        continue
+                resolved.append(task)
+            queue.delete_tasks(resolved)
+            if len(resolved) < len(tasks):
+                # pick the unresolved tickets up again once their lease is over
+                ConferenceApi._queueRegistrationDrain(c_key, continuation=True, countdown=REGISTRATION_LEASE)
+                return
+            if len(tasks) < REGISTRATION_BATCH:
+                return
+
+        # the queue is still not empty; continue in a fresh task
+        ConferenceApi._queueRegistrationDrain(c_key, continuation=True)
+
+    @staticmethod
+    def _resolveTicket(ticket, conf):
+        """Run the registration for ticket, recording a rejection on conflict."""
+        if not conf:
+            ConferenceApi._rejectTicket(ticket.key, 'The conference no longer exists.')
+            return
+        try:
+            ConferenceApi._registerProfile(ticket.key.parent(), conf, ticket_key=ticket.key)
+        except ConflictException as e:
+            ConferenceApi._rejectTicket(ticket.key, e.message)
+
+    @staticmethod
+    @ndb.transactional()
+    def _rejectTicket(ticket_key, reason):
+        """Mark a still pending ticket as rejected."""
+        ticket = ticket_key.get()
+        if ticket.status == str(RegistrationStatus.PENDING):
+            ticket.status = str(RegistrationStatus.REJECTED)
+            ticket.reason = reason
+            ticket.put()
+
+    @staticmethod
+    def _queueRebalance(c_key):
+        """Enqueue a rebalance of the conference's seat shards; at most one per window."""
+        try:
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                          url='/tasks/rebalance_seats',
+                          name='rebalance-%s-%d' % (c_key.urlsafe(), time.time() // REBALANCE_WINDOW))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # a rebalance for this window is already queued
+            pass
+
+    @staticmethod
+    def _rebalanceSeats(request):
+        """Spread a conference's seats evenly over its shards; used by the rebalance task."""
+        c_key = ndb.Key(urlsafe=request.get('websafeConferenceKey'))
+        total = request.get('seats')
+        seats.rebalanceShards(c_key, int(total) if total else None)
+        ConferenceApi._etagsChanged([c_key.urlsafe()])
+        ConferenceApi._updateNearlySoldOut([c_key])
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conference/registration',
@@ -388,28 +1147,40 @@ class ConferenceApi(remote.Service):
     def conferenceGetToAttend(self, request):
         """Get a list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        # conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferencesToAttend]
-        conferences = ndb.get_multi(prof.conferencesToAttend)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # skip registrations whose conference has been deleted since
+        conferences = [conf for conf in ndb.get_multi(self._memberKeys(Registration, prof.key)) if conf]
+        self._fillOrganizerNames(conferences)
+        seats_available = seats.getSeatsAvailable(conferences)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) \
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, seats_available[conf.key]) \
                                       for conf in conferences])
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_GET_REQUEST, RegistrationForm,
                       path='conference/registration',
                       http_method='POST', name='conferenceRegisterFor')
     def conferenceRegisterFor(self, request):
-        """Register user for selected conference."""
-        return self._registerForConference(request)
+        """Register user for selected conference; high demand conferences return a pending ticket."""
+        prof = self._getProfileFromUser()  # get user Profile
+        conf, c_key = self._validateKey(request.websafeKey)
+        if conf.highDemand:
+            return self._queueRegistration(prof, conf)
+
+        retval = self._registerProfile(prof.key, conf)
+        return RegistrationForm(data=retval, status=RegistrationStatus.REGISTERED,
+                                websafeConferenceKey=c_key.urlsafe())
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationForm,
+                      path='conference/registration/ticket',
+                      http_method='GET', name='conferenceGetRegistrationTicket')
+    def conferenceGetRegistrationTicket(self, request):
+        """Return the status of a queued registration ticket by websafeKey."""
+        prof = self._getProfileFromUser()  # get user Profile
+        ticket, t_key = self._validateKey(request.websafeKey)
+        if not isinstance(ticket, RegistrationTicket) or t_key.parent() != prof.key:
+            raise endpoints.NotFoundException(
+                'No registration ticket found with key: %s' % request.websafeKey)
+        return self._copyTicketToForm(ticket)
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/registration',
@@ -431,6 +1202,8 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        # a != filter runs as several queries, which can only be paged in key order
+        q = q.order(Conference.key)
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
@@ -469,41 +1242,28 @@ class ConferenceApi(remote.Service):
     @endpoints.method(ConferenceQueryForms, ConferenceForms, path='conference',
                       http_method='GET', name='conferenceQuery')
     def conferenceQuery(self, request):
-        """Query for conferences by criteria or query all if none specified."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Query for conferences by criteria or query all if none specified, one page at a time."""
+        conferences, next_page = self._fetchPage(self._getQuery(request), request)
+        self._fillOrganizerNames(conferences)
+        seats_available = seats.getSeatsAvailable(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
-                   for conf in conferences])
+            items=[self._copyConferenceToForm(conf, seats_available[conf.key]) for conf in conferences],
+            nextPageToken=next_page)
 
     # - - - Profile objects - - - - - - - - - - - - - - - - - - -
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return copyProfileToForm(prof)
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        ctx = self._requestContext()
+        # the Profile is loaded at most once per request
+        if ctx.profile is not None:
+            return ctx.profile
+
         user, user_id = self._validateUser()
 
         p_key = ndb.Key(Profile, user_id)
@@ -517,7 +1277,11 @@ class ConferenceApi(remote.Service):
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+        # profiles from before Registration and WishlistEntry are migrated when first used
+        elif profile.conferencesToAttend or profile.sessionsWishlist:
+            profile = self._migrateProfile(p_key)
 
+        ctx.profile = profile
         return profile  # return Profile
 
     def _doProfile(self, save_request=None):
@@ -527,6 +1291,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            old_name = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -538,6 +1303,10 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         prof.put()
 
+            # conferences carry a copy of the organizer's name
+            if prof.displayName != old_name:
+                self._queueOrganizerNameUpdates([prof.key.id()])
+
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
@@ -554,47 +1323,73 @@ class ConferenceApi(remote.Service):
         return self._doProfile(request)
 
     # - - - - - - - - - - - - Sessions - - - - - - - - - - - - - -
-    def _copySessionToForm(self, sess):
+    @staticmethod
+    def _copySessionToForm(sess, speaker=None):
         """Copy relevant fields from Session to SessionOutForm."""
-        sf = SessionOutForm()
-        if sess.speakerKey:
-            # Has knowledge of the SessionOutModel fields
+        sf = copySessionToForm(sess)
+        if sess.speakerKey and not speaker:
             speaker = sess.speakerKey.get()
-            sf.speakerName = speaker.name
-            sf.speakerBio = speaker.bio
-            sf.speakerCredentials = speaker.credentials
-            sf.speakerTitle = speaker.title
-            sf.speakerEmail = speaker.email
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                # convert Date to date string; just copy others
-                if field.name == 'date':
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                elif field.name == 'startTime':
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, sess.key.urlsafe())
-        sf.check_initialized()
+        if speaker:
+            copySpeakerToSessionForm(speaker, sf)
         return sf
 
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionInForm/request."""
-        # preload necessary data items
-        user, user_id = self._validateUser()
+    @staticmethod
+    def _copySessionsToForms(sessions, nextPageToken=None, compact=False):
+        """Copy a list of Sessions to SessionForms, fetching all speakers in one batch;
+        compact lists each speaker once in speakers instead of in every session."""
+        sessions = list(sessions)
+        # collect distinct speaker keys, in first seen order, so each speaker is only fetched once
+        speakers = OrderedDict((sess.speakerKey, None) for sess in sessions if sess.speakerKey)
+        speakers.update(zip(speakers.keys(), ndb.get_multi(speakers.keys())))
+
+        if compact:
+            return SessionForms(
+                items=[copySessionToForm(sess) for sess in sessions],
+                speakers=[copySpeakerToForm(speaker) for speaker in speakers.values() if speaker],
+                nextPageToken=nextPageToken
+            )
+        return SessionForms(
+            items=[ConferenceApi._copySessionToForm(sess, speakers.get(sess.speakerKey)) for sess in sessions],
+            nextPageToken=nextPageToken
+        )
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+    @staticmethod
+    def _compactForms(forms):
+        """Move the speaker fields of SessionForms' sessions into speakers, once per speaker."""
+        listed = set(sf.websafeKey for sf in forms.speakers)
+        for item in forms.items:
+            s_key = item.websafeSpeakerKey
+            if s_key and s_key not in listed and item.speakerName is not None:
+                listed.add(s_key)
+                forms.speakers.append(SpeakerForm(websafeKey=s_key, **dict(
+                    (speaker_field, getattr(item, field)) for field, speaker_field in SPEAKER_SESSION_FIELDS.items())))
+            for field in SPEAKER_SESSION_FIELDS:
+                item.reset(field)
+        return forms
 
-        # check if conf exists given websafeKey
-        conf, data['conferenceKey'] = self._validateKey(request.websafeConferenceKey)
+    @staticmethod
+    def _expandForms(forms):
+        """Copy each speaker of compact SessionForms into their sessions; reverses _compactForms."""
+        speakers = dict((sf.websafeKey, sf) for sf in forms.speakers)
+        for item in forms.items:
+            sf = speakers.get(item.websafeSpeakerKey)
+            if sf:
+                for field, speaker_field in SPEAKER_SESSION_FIELDS.items():
+                    setattr(item, field, getattr(sf, speaker_field))
+        forms.reset('speakers')
+        return forms
+
+    def _sessionData(self, request, user_id, conf, speaker=None):
+        """Validate a SessionInForm for its conference and speaker and return the
+        Session fields for it, without the key."""
         if conf.organizerUserId != user_id:
             raise endpoints.UnauthorizedException('User is not conference organizer.')
 
-        if request.websafeSpeakerKey:
-            # will raise error if speaker key is invalid
-            speaker, data['speakerKey'] = self._validateKey(request.websafeSpeakerKey)
+        # copy SessionInForm/ProtoRPC Message into dict
+        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        data['conferenceKey'] = conf.key
+        if speaker:
+            data['speakerKey'] = speaker.key
 
         # add default values for those missing (both data model & outbound Message)
         for df in SESSION_DEFAULTS:
@@ -608,24 +1403,200 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'], "%H:%M").time()
 
-        sess_id = Session.allocate_ids(size=1, parent=data['conferenceKey'])[0]
-        sess_key = ndb.Key(Session, sess_id, parent=data['conferenceKey'])
-        data['key'] = sess_key
-
         del data['websafeKey']
         del data['websafeSpeakerKey']
         del data['websafeConferenceKey']
+        return data
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning SessionInForm/request."""
+        # preload necessary data items
+        user, user_id = self._validateUser()
+
+        # check if conf exists given websafeKey
+        conf, c_key = self._validateKey(request.websafeConferenceKey)
+        speaker = None
+        if request.websafeSpeakerKey:
+            # will raise error if speaker key is invalid
+            speaker, s_key = self._validateKey(request.websafeSpeakerKey)
+        data = self._sessionData(request, user_id, conf, speaker)
+
+        sess_id = Session.allocate_ids(size=1, parent=c_key)[0]
+        sess = Session(key=ndb.Key(Session, sess_id, parent=c_key), **data)
 
         # create Session, send email to organizer confirming
         # creation of Session and return SessionForm
-        Session(**data).put()
-        sess = sess_key.get()
-        if request.websafeSpeakerKey:
-            taskqueue.add(params={'websafeSpeakerKey': request.websafeSpeakerKey, 'websafeConferenceKey': request.websafeConferenceKey},
-                          url='/tasks/set_featured_speaker')
-        taskqueue.add(params={'email': user.email(), 'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email')
-        return self._copySessionToForm(sess)
+        speakers = {speaker.key: speaker} if speaker else {}
+        self._addTasks(self._writeSessions(c_key, [sess], speakers, user.email()))
+        search.index([sess])
+        return self._copySessionToForm(sess, speaker)
+
+    def _writeSessions(self, c_key, sessions, speakers, email):
+        """Write new sessions of one conference, announce featured speakers and
+        return the summary email and agenda rebuild tasks to queue for them."""
+        for tally in self._putSessions(c_key, sessions, speakers):
+            self._setFeaturedSpeaker(tally)
+        # until the rebuild has run, readers get the agenda from the datastore
+        memcache.delete_multi([MEMCACHE_AGENDA_PREFIX + c_key.urlsafe(),
+                               MEMCACHE_ETAG_PREFIX + self._agendaStamp(c_key)], seconds=ETAG_LOCK)
+        return [self._sessionSummaryTask(sessions[0], email), self._agendaTask(c_key)]
+
+    def _createSessionObjects(self, request):
+        """Create the Sessions of a SessionInForms; returns a result per form."""
+        user, user_id = self._validateUser()
+        self._checkBatchSize(request.items)
+
+        # every conference and speaker referred to, fetched in one batch
+        keys = set()
+        for item in request.items:
+            keys.update(key for key in (self._parseKey(item.websafeConferenceKey),
+                                        self._parseKey(item.websafeSpeakerKey)) if key)
+        keys = list(keys)
+        entities = dict(zip(keys, ndb.get_multi(keys)))
+
+        def prepare(item):
+            conf = self._prefetched(entities, item.websafeConferenceKey, 'Conference')
+            speaker = None
+            if item.websafeSpeakerKey:
+                speaker = self._prefetched(entities, item.websafeSpeakerKey, 'Speaker')
+            return self._sessionData(item, user_id, conf, speaker)
+
+        results, valid = self._batchResults(request.items, prepare)
+        groups = {}
+        for i, data in valid:
+            groups.setdefault(data['conferenceKey'], []).append((i, data))
+        speakers = dict((key, entity) for key, entity in entities.items() if entity and key.kind() == 'Speaker')
+
+        written, tasks = [], []
+        for c_key, group in groups.items():
+            # one id allocation and one transaction per conference
+            first, last = Session.allocate_ids(size=len(group), parent=c_key)
+            sessions = [Session(key=ndb.Key(Session, s_id, parent=c_key), **data)
+                        for s_id, (i, data) in zip(range(first, last + 1), group)]
+            try:
+                tasks.extend(self._writeSessions(c_key, sessions, speakers, user.email()))
+            except datastore_errors.TransactionFailedError:
+                for i, data in group:
+                    results[i].error = 'Too much contention on the conference; try again.'
+                continue
+            written.extend(sessions)
+            for (i, data), sess in zip(group, sessions):
+                results[i].websafeKey = sess.key.urlsafe()
+
+        self._addTasks(tasks)
+        search.index(written)
+        return BatchResultForms(items=results)
+
+    @staticmethod
+    def _sessionSummaryTask(sess, email):
+        """Return the summary email task for the window the session was created in; one per conference."""
+        window = int(calendar.timegm(sess.created.utctimetuple()) // SESSION_SUMMARY_WINDOW)
+        c_key = sess.conferenceKey
+        # runs once the window has closed, so it sees every session created in it
+        return taskqueue.Task(params={'websafeConferenceKey': c_key.urlsafe(), 'email': email, 'window': window},
+                              url='/tasks/send_session_summary', countdown=SESSION_SUMMARY_WINDOW,
+                              name='session-summary-%s-%d' % (c_key.urlsafe(), window))
+
+    @staticmethod
+    def _sessionSummary(request):
+        """Return the summary email body for a window's new sessions, None if there are none."""
+        c_key = ndb.Key(urlsafe=request.get('websafeConferenceKey'))
+        start = int(request.get('window')) * SESSION_SUMMARY_WINDOW
+        sessions = Session.query(ancestor=c_key) \
+            .filter(Session.created >= datetime.utcfromtimestamp(start)) \
+            .filter(Session.created < datetime.utcfromtimestamp(start + SESSION_SUMMARY_WINDOW)) \
+            .order(Session.created).fetch()
+        if not sessions:
+            return None
+        conf = c_key.get()
+        lines = ['- %s%s' % (sess.name, ' (%s %s)' % (sess.date, sess.startTime) if sess.date else '')
+                 for sess in sessions]
+        return 'Hi, you have added %d session(s) to %s:\r\n\r\n%s' % (
+            len(sessions), conf.name if conf else 'your conference', '\r\n'.join(lines))
+
+    @staticmethod
+    @ndb.transactional()
+    def _putSessions(c_key, sessions, speakers):
+        """Put sessions of one conference, bump its Agenda version and count them in
+        their speakers' SpeakerSessions; returns the SpeakerSessions touched."""
+        a_key = ndb.Key(Agenda, AGENDA_ID, parent=c_key)
+        s_keys = sorted(set(sess.speakerKey for sess in sessions if sess.speakerKey))
+        t_keys = [ndb.Key(SpeakerSessions, str(s_key.id()), parent=c_key) for s_key in s_keys]
+        fetched = ndb.get_multi([a_key] + t_keys)
+
+        tallies = {}
+        for s_key, t_key, tally in zip(s_keys, t_keys, fetched[1:]):
+            if tally is None:
+                # first session of this speaker here since tallies exist: count the
+                # earlier ones once (an ancestor query, so it may run in the transaction)
+                earlier = Session.query(ancestor=c_key).filter(Session.speakerKey == s_key).fetch()
+                tally = SpeakerSessions(key=t_key, speakerKey=s_key,
+                                        sessionNames=[s.name for s in earlier], count=len(earlier))
+            tally.speakerName = speakers[s_key].name
+            tallies[s_key] = tally
+        for sess in sessions:
+            if sess.speakerKey:
+                tallies[sess.speakerKey].sessionNames.append(sess.name)
+                tallies[sess.speakerKey].count += 1
+
+        agenda = fetched[0] or Agenda(key=a_key)
+        agenda.version += 1
+        # sessions, tallies and the agenda share the conference's entity group
+        ndb.put_multi(sessions + tallies.values() + [agenda])
+        return tallies.values()
+
+    # - - - Agenda - - - - - - - - - - - - - - - - - - - - - - - -
+    @staticmethod
+    def _agendaTask(c_key):
+        """Return the named task rebuilding the conference's Agenda; one per window."""
+        window = int(time.time() // AGENDA_WINDOW)
+        # runs once the window has closed, after every session write made in it
+        return taskqueue.Task(params={'websafeConferenceKey': c_key.urlsafe()},
+                              url='/tasks/rebuild_agenda', countdown=AGENDA_WINDOW,
+                              name='agenda-%s-%d' % (c_key.urlsafe(), window))
+
+    @staticmethod
+    def _agendaForms(c_key, compact=True):
+        """Return the conference's sessions as SessionForms, ordered by date and startTime."""
+        sessions = Session.query(ancestor=c_key).fetch()
+        # undated and untimed sessions go last
+        sessions.sort(key=lambda sess: (sess.date is None, sess.date,
+                                        sess.startTime is None, sess.startTime, sess.key.id()))
+        return ConferenceApi._copySessionsToForms(sessions, compact=compact)
+
+    @staticmethod
+    def _rebuildAgenda(request):
+        """Serialize a conference's agenda into its Agenda and memcache; used by the rebuild task."""
+        c_key = ndb.Key(urlsafe=request.get('websafeConferenceKey'))
+        a_key = ndb.Key(Agenda, AGENDA_ID, parent=c_key)
+        conf, agenda = ndb.get_multi([c_key, a_key])
+        if not conf:
+            # no agendas for conferences that do not exist (any more)
+            return
+        version = agenda.version if agenda else 0
+        if agenda and agenda.builtVersion == version:
+            return
+
+        # the version is read before the sessions, so a payload never claims
+        # a version newer than what it holds; stored compact, speakers once
+        payload = protobuf.encode_message(ConferenceApi._agendaForms(c_key))
+        if ConferenceApi._storeAgenda(a_key, version, payload):
+            # the stamp moves with the cached copy, whose version it names
+            memcache.set_multi({MEMCACHE_AGENDA_PREFIX + c_key.urlsafe(): (version, payload),
+                                MEMCACHE_ETAG_PREFIX + ConferenceApi._agendaStamp(c_key): 'a%d' % version})
+
+    @staticmethod
+    @ndb.transactional()
+    def _storeAgenda(a_key, version, payload):
+        """Store the payload built at version unless a session was written since; True if stored."""
+        agenda = a_key.get() or Agenda(key=a_key)
+        if agenda.version != version:
+            # that write queued its own rebuild
+            return False
+        agenda.builtVersion = version
+        agenda.payload = payload
+        agenda.put()
+        return True
 
     @endpoints.method(CONF_GET_BY_TYPE_REQUEST, SessionForms,
                       path='session/conference/type',
@@ -636,24 +1607,60 @@ class ConferenceApi(remote.Service):
         conf, c_key = self._validateKey(request.websafeKey)
         c_sessions = Session.query(ancestor=c_key)
         c_sessions = c_sessions.filter(Session.typeOfSession == request.type)
-        # return set of ConferenceForm objects per Conference
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in c_sessions]
-        )
+        # return set of SessionOutForm objects per Session
+        return self._copySessionsToForms(c_sessions, compact=request.compact)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @staticmethod
+    def _agendaStamp(c_key):
+        """Return the ETag stamp name of a conference's sessions."""
+        return 'sessions:' + c_key.urlsafe()
+
+    def _servedAgenda(self, payload, compact):
+        """Decode a stored agenda payload into the representation asked for."""
+        forms = protobuf.decode_message(SessionForms, payload)
+        # payloads stored before agendas were kept compact hold full sessions
+        if compact:
+            return self._compactForms(forms)
+        return self._expandForms(forms)
+
+    @endpoints.method(SESSION_GET_REQUEST, SessionForms,
                       path='session/conference',
                       http_method='GET', name='sessionGetByConference')
     def sessionGetByConference(self, request):
-        """Return sessions under conference."""
-        # create ancestor query for all key matches for this user
-        c_sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeKey))
-
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in c_sessions]
-        )
-
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+        """Return sessions under conference, ordered by date and startTime; 304 if
+        ifNoneMatch is still current."""
+        c_key = self._parseKey(request.websafeKey)
+        if c_key is None:
+            raise endpoints.BadRequestException('The key is of an incorrect format: %s' % request.websafeKey)
+        if c_key.kind() != 'Conference':
+            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeKey)
+        stamp = self._agendaStamp(c_key)
+        # compact and full responses of the same version get different tags
+        variant = '.c' if request.compact else ''
+        client_etag = self._ifNoneMatch(request, stamp, variant)
+        # the tag is the Agenda version the sessions were served at
+        cached = memcache.get(MEMCACHE_AGENDA_PREFIX + c_key.urlsafe())
+        if cached:
+            etag = self._checkETag(stamp, 'a%d' % cached[0], client_etag, variant)
+            forms = self._servedAgenda(cached[1], request.compact)
+        else:
+            agenda = ndb.Key(Agenda, AGENDA_ID, parent=c_key).get()
+            # read before the sessions of a live build, so never newer than them
+            etag = 'a%d' % (agenda.version if agenda else 0)
+            if agenda and agenda.builtVersion == agenda.version:
+                etag = self._checkETag(stamp, etag, client_etag, variant)
+                memcache.add(MEMCACHE_AGENDA_PREFIX + c_key.urlsafe(), (agenda.version, agenda.payload))
+                forms = self._servedAgenda(agenda.payload, request.compact)
+            else:
+                # not built yet, or a rebuild is pending: serve the sessions as they are
+                if not agenda:
+                    self._addTasks([self._agendaTask(c_key)])
+                etag += variant
+                forms = self._agendaForms(c_key, compact=request.compact)
+        forms.etag = etag
+        return forms
+
+    @endpoints.method(SESSION_GET_REQUEST, SessionForms,
                       path='session/speaker',
                       http_method='GET', name='sessionGetBySpeaker')
     def sessionGetBySpeaker(self, request):
@@ -662,9 +1669,7 @@ class ConferenceApi(remote.Service):
         speaker, s_key = self._validateKey(request.websafeKey)
         sessions = Session.query(Session.speakerKey == s_key)
         # return set of SessionOutForm objects for speaker
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions, compact=request.compact)
 
     @endpoints.method(SessionInForm, SessionOutForm,
                       path='session',
@@ -673,50 +1678,71 @@ class ConferenceApi(remote.Service):
         """Create new session."""
         return self._createSessionObject(request)
 
+    @endpoints.method(SessionInForms, BatchResultForms,
+                      path='session/batch',
+                      http_method='POST', name='sessionCreateBatch')
+    def sessionCreateBatch(self, request):
+        """Create many sessions; returns a result per session, with its key or error."""
+        return self._createSessionObjects(request)
+
     # - - - - - - - - - - - - Wishlist - - - - - - - - - - - - - -
     def _editWishlist(self, request, reg=True):
         """Add or remove session from user's wishlist."""
-        retval = None
         prof = self._getProfileFromUser()  # get user Profile
 
         # check if session exists given websafeKey
         sess, s_key = self._validateKey(request.websafeKey)
+        return BooleanMessage(data=self._setWishlisted(prof.key, s_key, reg))
+
+    @staticmethod
+    @ndb.transactional()
+    def _setWishlisted(p_key, s_key, reg=True):
+        """Add or remove the profile's WishlistEntry for a session; False if there was none to remove."""
+        w_key = ConferenceApi._memberKey(WishlistEntry, p_key, s_key)
+        entry = w_key.get()
 
         # register
         if reg:
             # check if session is already in wishlist
-            if s_key in prof.sessionsWishlist:
+            if entry:
                 raise ConflictException("This session is already in your wishlist.")
-
-            # register user, take away one seat
-            prof.sessionsWishlist.append(s_key)
-            retval = True
+            WishlistEntry(key=w_key, sessionKey=s_key).put()
+            return True
 
         # unregister
-        else:
-            # check if user already registered
-            if s_key in prof.sessionsWishlist:
-                # unregister user, add back one seat
-                prof.sessionsWishlist.remove(s_key)
-                retval = True
-            else:
-                retval = False
-
-        # write things back to the datastore & return
-        prof.put()
-        return BooleanMessage(data=retval)
-
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+        if not entry:
+            return False
+        w_key.delete()
+        return True
+
+    @ndb.tasklet
+    def _getSessionWithSpeaker_async(self, s_key):
+        """Tasklet returning a (session, speaker) pair; session is None if deleted."""
+        sess = yield s_key.get_async()
+        speaker = None
+        if sess and sess.speakerKey:
+            speaker = yield sess.speakerKey.get_async()
+        raise ndb.Return((sess, speaker))
+
+    @endpoints.method(WISHLIST_GET_REQUEST, SessionForms,
                       path='session/wishlist',
                       http_method='GET', name='sessionsGetFromWishlist')
     def sessionsGetFromWishlist(self, request):
         """Query for all the sessions that the user is interested in"""
         prof = self._getProfileFromUser()  # get user Profile
-        # sess_keys = [ndb.Key(urlsafe=wsk) for wsk in prof.sessionsWishlist]
-        sessions = [s_key.get() for s_key in prof.sessionsWishlist]
-
-        # return set of SessionOutForm objects per Session
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+        # start one tasklet per wishlist entry; ndb batches the session gets into
+        # a single RPC and the speaker gets into another as sessions come back
+        futures = [self._getSessionWithSpeaker_async(s_key)
+                   for s_key in self._memberKeys(WishlistEntry, prof.key)]
+        ndb.Future.wait_all(futures)
+
+        # skip entries whose session has been deleted since it was wishlisted
+        wished = [(sess, speaker) for sess, speaker in (f.get_result() for f in futures) if sess]
+        if request.compact:
+            speakers = OrderedDict((speaker.key, speaker) for sess, speaker in wished if speaker)
+            return SessionForms(items=[copySessionToForm(sess) for sess, speaker in wished],
+                                speakers=[copySpeakerToForm(speaker) for speaker in speakers.values()])
+        return SessionForms(items=[self._copySessionToForm(sess, speaker) for sess, speaker in wished])
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='session/wishlist',
@@ -736,59 +1762,72 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_BY_TYPES_REQUEST, SessionForms, path='session/types',
                       http_method='GET', name='sessionGetOfTypes')
     def sessionGetOfTypes(self, request):
-        """Return sessions for given types. """
-        # create ancestor query for all key matches for this user
+        """Return sessions for given types, one page at a time."""
         if not request.types:
             raise endpoints.BadRequestException("No types were given.")
 
-        sessions = Session.query()
-        # can accept array
-        sessions = sessions.filter(Session.typeOfSession.IN(request.types))
-        # return set of ConferenceForm objects per Conference
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+        # one key-ordered query per type, merged in place of an IN filter
+        queries = [Session.query(Session.typeOfSession == t).order(Session.key)
+                   for t in sorted(set(request.types))]
+        sessions, next_page = self._fetchMergedPage(queries, lambda sess: sess.key.flat(), request)
+        # return set of SessionOutForm objects per Session
+        return self._copySessionsToForms(sessions, next_page, request.compact)
 
     @endpoints.method(CONF_GET_BY_TIME_REQUEST, SessionForms, path='session/time',
                       http_method='GET', name='sessionGetByTime')
     def sessionGetByTime(self, request):
-        """Return sessions starting at/after a certain time"""
-        # create ancestor query for all key matches for this user
+        """Return sessions starting at/after a certain time, one page at a time."""
         sessionTime = datetime.strptime(request.time, "%H:%M").time()
 
-        sessions = Session.query(Session.startTime >= sessionTime)
+        sessions = Session.query(Session.startTime >= sessionTime).order(Session.startTime, Session.key)
+        sessions, next_page = self._fetchPage(sessions, request)
         # return set of SessionForm objects
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+        return self._copySessionsToForms(sessions, next_page, request.compact)
 
     @endpoints.method(CONF_GET_BY_TIME_TYPES_REQUEST, SessionForms, path='session/time/types',
                       http_method='GET', name='sessionGetByTimeByNotTypes')
     def sessionGetByTimeByNotTypes(self, request):
-        """Return sessions starting at/after a certain time and by types not given."""
-        # create ancestor query for all key matches for this user
+        """Return sessions starting at/after a certain time and by types not given, one page at a time."""
         sessionTime = datetime.strptime(request.time, "%H:%M").time()
-        types = set(SESSION_TYPES) - set(request.types)
-        sessions = Session.query()
-        # can accept array
-        sessions = sessions.filter(Session.startTime >= sessionTime)
-        sessions = sessions.filter(Session.typeOfSession.IN(types))
-        # return set of ConferenceForm objects per Conference
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+        types = sorted(set(SESSION_TYPES) - set(request.types))
+
+        # one (startTime, key)-ordered query per remaining type, merged in place of an IN filter
+        queries = [Session.query(Session.typeOfSession == t, Session.startTime >= sessionTime)
+                          .order(Session.startTime, Session.key)
+                   for t in types]
+        sessions, next_page = self._fetchMergedPage(
+            queries, lambda sess: (sess.startTime, sess.key.flat()), request)
+        # return set of SessionOutForm objects per Session
+        return self._copySessionsToForms(sessions, next_page, request.compact)
 
     # - - - Announcements - - - - - - - - - - - - - - - - - - - -
+    @staticmethod
+    def _featuredSpeakerKey(c_key):
+        """Return the memcache key of a conference's featured speaker."""
+        return '%s:%s' % (MEMCACHE_FEATURED_SPEAKER_KEY, c_key.urlsafe())
+
+    @staticmethod
+    def _featuredSpeakerAnnouncement(tally):
+        """Format the featured speaker announcement for a SpeakerSessions."""
+        return FEATURED_SPEAKER_STR % tally.speakerName + ', '.join(tally.sessionNames)
+
+    @staticmethod
+    def _setFeaturedSpeaker(tally):
+        """Announce the speaker of a SpeakerSessions as featured if they have 2+ sessions."""
+        if not tally or not tally.featured:
+            return
+        announcement = ConferenceApi._featuredSpeakerAnnouncement(tally)
+        # per conference, and under the global key as the latest featured speaker anywhere
+        memcache.set_multi({MEMCACHE_FEATURED_SPEAKER_KEY: announcement,
+                            ConferenceApi._featuredSpeakerKey(tally.key.parent()): announcement})
+
     @staticmethod
     def _cacheFeaturedSpeaker(request):
         """Create Announcement for featured speaker & assign to memcache."""
+        # sessionCreate announces inline now; this serves tasks queued before that
         c_key = ndb.Key(urlsafe=request.get('websafeConferenceKey'))
         s_key = ndb.Key(urlsafe=request.get('websafeSpeakerKey'))
-
-        sessions = Session.query(Session.conferenceKey == c_key)
-        sessions = sessions.filter(Session.speakerKey == s_key)
-        sessions = sessions.fetch()
-        if len(sessions) >= 2:
-            speaker = s_key.get()
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = FEATURED_SPEAKER_STR % speaker.name
-            announcement += ', '.join(sess.name for sess in sessions)
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, announcement)
+        ConferenceApi._setFeaturedSpeaker(ndb.Key(SpeakerSessions, str(s_key.id()), parent=c_key).get())
 
     @endpoints.method(message_types.VoidMessage, StringMessage, path='speaker/featured',
                       http_method='GET', name='speakerGetFeatured')
@@ -796,53 +1835,213 @@ class ConferenceApi(remote.Service):
         """Return featured speaker from memcache, if existent."""
         return StringMessage(data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or "")
 
+    @endpoints.method(CONF_GET_REQUEST, StringMessage, path='speaker/featured/{websafeKey}',
+                      http_method='GET', name='speakerGetFeaturedByConference')
+    def speakerGetFeaturedByConference(self, request):
+        """Return a conference's featured speaker, if it has one."""
+        try:
+            c_key = ndb.Key(urlsafe=request.websafeKey.strip())
+        except Exception:
+            raise endpoints.BadRequestException('The key is of an incorrect format: %s' % request.websafeKey)
+        if c_key.kind() != 'Conference':
+            raise endpoints.BadRequestException('Not a conference key: %s' % request.websafeKey)
+
+        announcement = memcache.get(self._featuredSpeakerKey(c_key))
+        if announcement is None:
+            # evicted: rebuild from the most recently updated featured speaker
+            tally = SpeakerSessions.query(ancestor=c_key).filter(SpeakerSessions.featured == True) \
+                .order(-SpeakerSessions.updated).get()
+            announcement = self._featuredSpeakerAnnouncement(tally) if tally else ''
+            memcache.set(self._featuredSpeakerKey(c_key), announcement)
+        return StringMessage(data=announcement)
+
+    # - - - - - - - - - - - - Search - - - - - - - - - - - - - -
+    @endpoints.method(SEARCH_REQUEST, SearchResultForms, path='search',
+                      http_method='GET', name='searchQuery')
+    def searchQuery(self, request):
+        """Search conferences, sessions and speakers by words; the last word may be partial."""
+        kinds = set(request.kinds)
+        if kinds - set(search.FIELDS):
+            raise endpoints.BadRequestException('Kinds can only be: %s' % ', '.join(sorted(search.FIELDS)))
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException('Invalid page token: %s' % request.pageToken)
+
+        page_size = self._pageSize(request)
+        hits, more, truncated = search.search(request.query, kinds, offset, page_size)
+        return SearchResultForms(
+            items=[SearchResultForm(kind=doc.entityKind, websafeKey=doc.targetKey.urlsafe(),
+                                    title=doc.title, score=float(score))
+                   for score, doc in hits],
+            nextPageToken=str(offset + page_size) if more else None,
+            truncated=truncated,
+        )
+
+    @staticmethod
+    def _queueReindex():
+        """Enqueue rebuilding the search documents of every searchable kind."""
+        ConferenceApi._addTasks([taskqueue.Task(params={'kind': kind}, url='/tasks/reindex')
+                                 for kind in sorted(search.FIELDS)])
+
+    @staticmethod
+    def _reindex(request):
+        """Index one batch of a kind's entities and queue the next; used by the reindex task."""
+        kind = request.get('kind')
+        cursor = Cursor(urlsafe=request.get('cursor')) if request.get('cursor') else None
+        entities, cursor, more = ndb.Query(kind=kind).fetch_page(REINDEX_BATCH, start_cursor=cursor)
+        search.index(entities)
+        if more and cursor:
+            taskqueue.add(params={'kind': kind, 'cursor': cursor.urlsafe()}, url='/tasks/reindex')
+
+    # - - - - - - - - - - - - Attendance Migration - - - - - - - - - - - - - -
+    @staticmethod
+    def _migrateProfile(p_key):
+        """Move a Profile's conferencesToAttend and sessionsWishlist into Registration and
+        WishlistEntry children, MIGRATION_BATCH at a time; returns the migrated Profile."""
+        prof, done = None, False
+        while not done:
+            prof, done = ConferenceApi._migrateProfileBatch(p_key)
+        return prof
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfileBatch(p_key):
+        """Move the next MIGRATION_BATCH list entries of a Profile; returns (Profile, done)."""
+        prof = p_key.get()
+        if not prof:
+            return None, True
+        # spaced a microsecond apart so the lists keep their order
+        created = datetime.utcnow()
+        entities = []
+        for model, name, prop in ((Registration, 'conferencesToAttend', 'conferenceKey'),
+                                  (WishlistEntry, 'sessionsWishlist', 'sessionKey')):
+            keys = getattr(prof, name)
+            moved = keys[:MIGRATION_BATCH - len(entities)]
+            for key in moved:
+                created += timedelta(microseconds=1)
+                entities.append(model(key=ConferenceApi._memberKey(model, p_key, key), created=created,
+                                      **{prop: key}))
+            setattr(prof, name, keys[len(moved):])
+        ndb.put_multi([prof] + entities)
+        return prof, not (prof.conferencesToAttend or prof.sessionsWishlist)
+
+    @staticmethod
+    def _migrateProfiles(profiles):
+        """Migrate those of profiles that still hold their lists."""
+        for prof in profiles:
+            if prof and (prof.conferencesToAttend or prof.sessionsWishlist):
+                ConferenceApi._migrateProfile(prof.key)
+
+    @staticmethod
+    def _queueAttendanceMigration():
+        """Enqueue migrating every Profile's registrations and wishlist."""
+        taskqueue.add(url='/tasks/migrate_attendance')
+
+    @staticmethod
+    def _migrateAttendance(request):
+        """Migrate one batch of Profiles and queue the next; used by the migration task."""
+        cursor = Cursor(urlsafe=request.get('cursor')) if request.get('cursor') else None
+        profiles, cursor, more = Profile.query().fetch_page(MIGRATION_PROFILES, start_cursor=cursor)
+        ConferenceApi._migrateProfiles(profiles)
+        if more and cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()}, url='/tasks/migrate_attendance')
+
     # - - - - - - - - - - - - Speaker - - - - - - - - - - - - - -
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
-        sf = SpeakerForm()
-        for field in sf.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, speaker.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        return copySpeakerToForm(speaker)
+
+    def _speakerData(self, request):
+        """Validate a SpeakerForm and return the Speaker fields for it."""
+        if not request.name:
+            raise endpoints.BadRequestException("Speaker 'name' field required")
+
+        # copy SpeakerForm/ProtoRPC Message into dict
+        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        del data['websafeKey']
+        del data['etag']
+        return data
 
     def _createSpeakerObject(self, request):
         """Create or update Speaker object, returning SpeakerForm/request."""
         # ensure user auth
         user, u_id = self._validateUser()
-
-        if not request.name:
-            raise endpoints.BadRequestException("Speaker 'name' field required")
+        data = self._speakerData(request)
 
         if request.email:
             q = Speaker.query(Speaker.email == request.email)
-            entity = q.get()
+            entity = q.get(keys_only=True)
             if entity:
                 raise endpoints.ForbiddenException('Email is already registered with a speaker.')
 
-        # copy SpeakerForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        s_key = Speaker(**data).put()
-        speaker = s_key.get()
-
+        speaker = Speaker(**data)
+        speaker.put()
+        self._speakersAdded([speaker])
         return self._copySpeakerToForm(speaker)
 
-    @endpoints.method(CONF_GET_REQUEST, SpeakerForm, path='speaker/{websafeKey}',
+    def _speakersAdded(self, speakers):
+        """Make new speakers searchable and suggestible."""
+        search.index(speakers)
+        suggest.speakerAdded()
+
+    def _createSpeakerObjects(self, request):
+        """Create the Speakers of a SpeakerForms; returns a result per form."""
+        user, u_id = self._validateUser()
+        self._checkBatchSize(request.items)
+
+        # emails already registered, one keys-only query per email, run in parallel;
+        # the datastore allows no projection on a property with an equality filter
+        emails = sorted(set(item.email for item in request.items if item.email))
+        futures = [Speaker.query(Speaker.email == email).get_async(keys_only=True) for email in emails]
+        taken = set(email for email, future in zip(emails, futures) if future.get_result())
+
+        def prepare(item):
+            data = self._speakerData(item)
+            if item.email in taken:
+                raise endpoints.ForbiddenException('Email is already registered with a speaker.')
+            if item.email:
+                # later items with the same email are rejected too
+                taken.add(item.email)
+            return data
+
+        results, valid = self._batchResults(request.items, prepare)
+        speakers = [Speaker(**data) for i, data in valid]
+        # root entities: ids are allocated by the put itself, in one batch
+        for (i, data), s_key in zip(valid, ndb.put_multi(speakers)):
+            results[i].websafeKey = s_key.urlsafe()
+        if speakers:
+            self._speakersAdded(speakers)
+        return BatchResultForms(items=results)
+
+    @endpoints.method(ETAG_GET_REQUEST, SpeakerForm, path='speaker/{websafeKey}',
                       http_method='GET', name='speakerGet')
     def speakerGet(self, request):
-        """Return speaker info for websafeKey."""
+        """Return speaker info for websafeKey; 304 if ifNoneMatch is still current."""
+        s_key = self._parseKey(request.websafeKey)
+        client_etag = self._ifNoneMatch(request, s_key and s_key.urlsafe())
         speaker, s_key = self._validateKey(request.websafeKey)
-        return self._copySpeakerToForm(speaker)
+        etag = self._checkETag(s_key.urlsafe(), 's%d' % speaker.version, client_etag)
+        sf = self._copySpeakerToForm(speaker)
+        sf.etag = etag
+        return sf
+
+    @endpoints.method(SPEAKER_SUGGEST_REQUEST, SpeakerForms,
+                      path='speaker/suggest',
+                      http_method='GET', name='speakerSuggest')
+    def speakerSuggest(self, request):
+        """Return speakers with a name word starting with prefix, for autocomplete."""
+        limit = min(request.limit or DEFAULT_SUGGESTIONS, MAX_SUGGESTIONS)
+        return SpeakerForms(items=[SpeakerForm(name=name, websafeKey=websafe)
+                                   for websafe, name in suggest.suggest(request.prefix, max(limit, 1))])
 
     @endpoints.method(SPEAKER_GET_BY, SpeakerForms,
                       path='speaker',
                       http_method='GET', name='speakerQuery')
     def speakerQuery(self, request):
-        """Return speakers by email, name, or query all if no criteria specified."""
+        """Return speakers by email, name, or query all if no criteria specified, one page at a time."""
         # should only return one speaker
         if request.email:
             speakers = Speaker.query(Speaker.email == request.email)
@@ -853,9 +2052,12 @@ class ConferenceApi(remote.Service):
         else:
             speakers = Speaker.query()
 
+        speakers, next_page = self._fetchPage(speakers, request)
+
         # return set of SpeakerForm objects per speaker matched
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            nextPageToken=next_page
         )
 
     @endpoints.method(SpeakerForm, SpeakerForm,
@@ -865,4 +2067,11 @@ class ConferenceApi(remote.Service):
         """Create new speaker."""
         return self._createSpeakerObject(request)
 
-api = endpoints.api_server([ConferenceApi], restricted=False)  # register API
+    @endpoints.method(SpeakerForms, BatchResultForms,
+                      path='speaker/batch',
+                      http_method='POST', name='speakerCreateBatch')
+    def speakerCreateBatch(self, request):
+        """Create many speakers; returns a result per speaker, with its key or error."""
+        return self._createSpeakerObjects(request)
+
+api = metrics.instrument(endpoints.api_server([ConferenceApi], restricted=False))  # register API
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+converters.py -- compiled ndb model to ProtoRPC message converters
+
+The field matching that used to run for every entity (all_fields(),
+hasattr/getattr and name checks) is done once per (model, message) pair
+when the converter is compiled; copying an entity then only walks a
+precomputed list of (field, getter, converter) entries.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+from operator import attrgetter
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+def _toUrlsafe(key):
+    """Convert an ndb Key to its websafe string."""
+    return key.urlsafe() if key else None
+
+
+def _toUrlsafeList(keys):
+    """Convert a list of ndb Keys to websafe strings."""
+    return [key.urlsafe() for key in keys]
+
+
+def _enumConverter(enum_type):
+    """Return a converter from an enum name string to the enum value."""
+    lookup = enum_type.lookup_by_name
+
+    def convert(name):
+        return lookup(name) if name else None
+    return convert
+
+
+def _fieldConverter(prop, field):
+    """Pick the converter for copying prop (None for the entity key) into field;
+    None means copy as is."""
+    if isinstance(field, messages.EnumField):
+        return _enumConverter(field.type)
+    if isinstance(prop, (ndb.DateProperty, ndb.TimeProperty, ndb.DateTimeProperty)):
+        # dates and times go out as their str() form, as they always have (None too)
+        return str
+    if prop is None or isinstance(prop, ndb.KeyProperty):
+        return _toUrlsafeList if field.repeated else _toUrlsafe
+    return None
+
+
+def compileConverter(model, message, sources=None, fields=None):
+    """Build a function copying entities of model into message instances.
+
+    sources maps a message field name to the model attribute it is read from
+    when the names differ ('key' for the entity key); fields limits the copy
+    to the named message fields. The returned function takes the entity and
+    optionally an existing message to fill, and returns the message.
+    """
+    sources = sources or {}
+    plan = []
+    for field in message.all_fields():
+        if fields is not None and field.name not in fields:
+            continue
+        source = sources.get(field.name, field.name)
+        if source == 'key':
+            prop = None
+        else:
+            prop = getattr(model, source, None)
+            if not isinstance(prop, ndb.Property):
+                # no matching model property; left for the caller to fill
+                continue
+        plan.append((field.name, attrgetter(source), _fieldConverter(prop, field)))
+    plan = tuple(plan)
+
+    def copy(entity, msg=None):
+        if msg is None:
+            msg = message()
+        for name, get, convert in plan:
+            value = get(entity)
+            if convert:
+                value = convert(value)
+            # None is what an unset message field already holds
+            if value is not None:
+                setattr(msg, name, value)
+        return msg
+
+    copy.__name__ = 'copy%sTo%s' % (model.__name__, message.__name__)
+    return copy
@@ -0,0 +1,52 @@
+"""
+endpoint_case.py -- base TestCase calling ConferenceApi endpoints on testbed stubs
+"""
+
+import json
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conference
+import metrics
+from benchmarks.endpoint_bench import AUTH_DOMAIN
+from benchmarks.endpoint_bench import PROJECT_ROOT
+from benchmarks.endpoint_bench import callEndpoint
+
+USER = 'user@%s' % AUTH_DOMAIN
+
+
+class EndpointTestCase(unittest.TestCase):
+    """Activates the stubs the endpoints use, with a strongly consistent datastore."""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='endpoint-test', overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=PROJECT_ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        ndb.get_context().clear_cache()
+        # sampled stats flushes are not under test
+        metrics.SAMPLE_RATE = 0
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def call(self, method, body, user=USER):
+        """Call the endpoint as user (None for anonymous); returns (status, decoded body)."""
+        ndb.get_context().clear_cache()
+        response = callEndpoint(conference.api, method, user, body)
+        return response.status_int, json.loads(response.body or '{}')
+
+    def callOk(self, method, body, user=USER):
+        """Call the endpoint and return its decoded body, failing unless it answered 200."""
+        status, answer = self.call(method, body, user)
+        self.assertEqual(200, status, '%s answered %d: %s' % (method, status, answer))
+        return answer
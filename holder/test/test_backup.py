@@ -0,0 +1,50 @@
+"""
+NDJSON import (backup.py) on testbed stubs.
+
+Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import json
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import backup
+from benchmarks.endpoint_bench import PROJECT_ROOT
+from models import ImportChunk
+from models import Speaker
+
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=PROJECT_ROOT)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testRetriedChunkCountedOnce(self):
+        job = backup.startImport()
+        records = [backup.toRecord(Speaker(key=ndb.Key(Speaker, i + 1), name='Speaker %d' % i))
+                   for i in range(3)]
+        backup.addImportChunk(job.key.id(), 0, ''.join(json.dumps(record) + '\n' for record in records))
+        backup.importChunk(job.key.id(), 0)
+        chunk_key = ndb.Key(ImportChunk, 1, parent=job.key)
+        # a task retried after the count committed
+        backup._countImportChunk(chunk_key, 3)
+        backup.importChunk(job.key.id(), 0)
+
+        job = job.key.get()
+        self.assertEqual((1, 3), (job.chunks, job.count))
+        self.assertEqual(3, Speaker.query().count())
+
+
+if __name__ == '__main__':
+    unittest.main()
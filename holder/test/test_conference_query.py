@@ -0,0 +1,56 @@
+"""
+conferenceQuery paging on testbed stubs.
+
+Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from endpoint_case import EndpointTestCase
+from endpoint_case import USER
+from models import Conference
+from models import Profile
+
+CITIES = ['Berlin', 'London', 'Paris', 'London', 'Tokyo', 'Berlin', 'London', 'Lima']
+
+
+class ConferenceQueryTest(EndpointTestCase):
+
+    def setUp(self):
+        super(ConferenceQueryTest, self).setUp()
+        p_key = ndb.Key(Profile, USER)
+        ndb.put_multi([Profile(key=p_key, displayName='Organizer', mainEmail=USER)] + [
+            Conference(key=ndb.Key(Conference, i + 1, parent=p_key), name='Conference %d' % i,
+                       organizerUserId=USER, organizerDisplayName='Organizer', city=city,
+                       maxAttendees=10, seatsAvailable=10)
+            for i, city in enumerate(CITIES)])
+
+    def pages(self, filters, pageSize):
+        """Return the conference names of every page of the query, in order."""
+        names, token = [], None
+        while True:
+            body = {'filters': filters, 'pageSize': pageSize}
+            if token:
+                body['pageToken'] = token
+            answer = self.callOk('conferenceQuery', body, user=None)
+            names.extend(item['name'] for item in answer.get('items', []))
+            token = answer.get('nextPageToken')
+            if not token:
+                return names
+
+    def testPagesNotEqualQuery(self):
+        names = self.pages([{'field': 'CITY', 'operator': 'NE', 'value': 'London'}], pageSize=2)
+        expected = sorted((city, 'Conference %d' % i) for i, city in enumerate(CITIES) if city != 'London')
+        self.assertEqual([name for city, name in expected], names)
+
+    def testPagesInequalityQuery(self):
+        names = self.pages([{'field': 'CITY', 'operator': 'GT', 'value': 'Lima'}], pageSize=3)
+        expected = sorted((city, 'Conference %d' % i) for i, city in enumerate(CITIES) if city > 'Lima')
+        self.assertEqual([name for city, name in expected], names)
+
+
+if __name__ == '__main__':
+    unittest.main()
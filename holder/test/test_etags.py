@@ -0,0 +1,67 @@
+"""
+Conditional GETs (etag / ifNoneMatch) on testbed stubs.
+
+The endpoints are called through the api_server, so a not modified answer
+is checked as the HTTP status the SPI sends. Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from endpoint_case import EndpointTestCase
+from endpoint_case import USER
+from models import Conference
+from models import Profile
+from models import Speaker
+
+
+class ETagTest(EndpointTestCase):
+
+    def setUp(self):
+        super(ETagTest, self).setUp()
+        p_key = ndb.Key(Profile, USER)
+        self.c_key = ndb.Key(Conference, 1, parent=p_key)
+        self.s_key = ndb.Key(Speaker, 1)
+        ndb.put_multi([
+            Profile(key=p_key, displayName='Organizer', mainEmail=USER),
+            Conference(key=self.c_key, name='Conference', organizerUserId=USER,
+                       organizerDisplayName='Organizer', maxAttendees=10, seatsAvailable=10),
+            Speaker(key=self.s_key, name='Speaker'),
+        ])
+
+    def revalidate(self, method, websafeKey):
+        """Get the entity, then revalidate the tag; returns the tag."""
+        etag = self.callOk(method, {'websafeKey': websafeKey}, user=None)['etag']
+        status, answer = self.call(method, {'websafeKey': websafeKey, 'ifNoneMatch': etag}, user=None)
+        self.assertEqual(304, status, '%s answered %d: %s' % (method, status, answer))
+        return etag
+
+    def assertNewTag(self, method, websafeKey, etag):
+        answer = self.callOk(method, {'websafeKey': websafeKey, 'ifNoneMatch': etag}, user=None)
+        self.assertNotEqual(etag, answer['etag'])
+        # and the new tag is current in turn
+        status, _ = self.call(method, {'websafeKey': websafeKey, 'ifNoneMatch': answer['etag']}, user=None)
+        self.assertEqual(304, status)
+
+    def testConferenceGet(self):
+        etag = self.revalidate('conferenceGet', self.c_key.urlsafe())
+        self.callOk('conferenceUpdate', {'websafeKey': self.c_key.urlsafe(), 'city': 'Paris'})
+        self.assertNewTag('conferenceGet', self.c_key.urlsafe(), etag)
+
+    def testSpeakerGet(self):
+        etag = self.revalidate('speakerGet', self.s_key.urlsafe())
+        speaker = self.s_key.get()
+        speaker.bio = 'Changed'
+        speaker.put()
+        self.assertNewTag('speakerGet', self.s_key.urlsafe(), etag)
+
+    def testStaleTagGetsFullResponse(self):
+        answer = self.callOk('speakerGet', {'websafeKey': self.s_key.urlsafe(), 'ifNoneMatch': 'stale'},
+                             user=None)
+        self.assertEqual('Speaker', answer['name'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Auth checks and Profile gets per endpoint.
+
+A request checks authorization and loads the caller's Profile at most once,
+however many ConferenceApi helpers need them (RequestContext). Run from the
+project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import unittest
+from datetime import date
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conference
+import metrics
+import seats
+from benchmarks.endpoint_bench import AUTH_DOMAIN
+from benchmarks.endpoint_bench import PROJECT_ROOT
+from benchmarks.endpoint_bench import callEndpoint
+from models import Conference
+from models import Profile
+from models import Session
+from models import Speaker
+
+USER = 'organizer@%s' % AUTH_DOMAIN
+NEW_USER = 'newcomer@%s' % AUTH_DOMAIN
+
+
+class RequestContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='request-context-test', overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=PROJECT_ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        ndb.get_context().clear_cache()
+
+        # sampled stats flushes would add gets of their own
+        metrics.SAMPLE_RATE = 0
+
+        p_key = ndb.Key(Profile, USER)
+        self.c_key = ndb.Key(Conference, 1, parent=p_key)
+        self.s_key = ndb.Key(Session, 1, parent=self.c_key)
+        speaker = Speaker(key=ndb.Key(Speaker, 1), name='Speaker', email='speaker@%s' % AUTH_DOMAIN)
+        ndb.put_multi([
+            Profile(key=p_key, displayName='Organizer', mainEmail=USER),
+            Conference(key=self.c_key, name='Conference', organizerUserId=USER,
+                       organizerDisplayName='Organizer', startDate=date(2017, 6, 1), month=6,
+                       maxAttendees=100, seatsAvailable=100, seatShards=seats.SEAT_SHARDS),
+            Session(key=self.s_key, name='Session', conferenceKey=self.c_key, speakerKey=speaker.key),
+            speaker,
+        ] + seats.createShards(self.c_key, 100))
+
+        self.counts = {'get_current_user': 0, 'getUserId': 0, 'profileGets': 0}
+        self._patch(conference.endpoints, 'get_current_user', 'get_current_user')
+        self._patch(conference, 'getUserId', 'getUserId')
+        # Key.get and ndb.get_multi both go through Key.get_async
+        counts = self.counts
+        get_async = ndb.Key.get_async
+
+        def countingGetAsync(key, **ctx_options):
+            if key.kind() == 'Profile':
+                counts['profileGets'] += 1
+            return get_async(key, **ctx_options)
+        ndb.Key.get_async = countingGetAsync
+        self.addCleanup(setattr, ndb.Key, 'get_async', get_async)
+
+    def _patch(self, owner, attr, name):
+        """Replace owner.attr with a wrapper counting its calls under name."""
+        original = getattr(owner, attr)
+        counts = self.counts
+
+        def counting(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        setattr(owner, attr, counting)
+        self.addCleanup(setattr, owner, attr, original)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def call(self, method, body, user=USER):
+        """Call the endpoint as user with a cold ndb cache; returns (status, counts)."""
+        ndb.get_context().clear_cache()
+        for name in self.counts:
+            self.counts[name] = 0
+        response = callEndpoint(conference.api, method, user, body)
+        return response.status_int, dict(self.counts)
+
+    def assertOnce(self, method, body, user=USER, profileGets=1):
+        status, counts = self.call(method, body, user)
+        self.assertEqual(200, status, '%s answered %d' % (method, status))
+        self.assertEqual({'get_current_user': 1, 'getUserId': 1, 'profileGets': profileGets}, counts, method)
+
+    def testConferenceCreate(self):
+        self.assertOnce('conferenceCreate', {'name': 'New conference', 'maxAttendees': 10})
+
+    def testConferenceCreateBatch(self):
+        self.assertOnce('conferenceCreateBatch', {'items': [{'name': 'First'}, {'name': 'Second'}]})
+
+    def testConferenceUpdate(self):
+        self.assertOnce('conferenceUpdate', {'websafeKey': self.c_key.urlsafe(), 'city': 'Paris'},
+                        profileGets=0)
+
+    def testRegistration(self):
+        body = {'websafeKey': self.c_key.urlsafe()}
+        self.assertOnce('conferenceRegisterFor', body)
+        self.assertOnce('conferenceGetToAttend', {})
+        self.assertOnce('conferenceUnregisterFrom', body)
+
+    def testWishlist(self):
+        body = {'websafeKey': self.s_key.urlsafe()}
+        self.assertOnce('sessionAddToWishlist', body)
+        self.assertOnce('sessionsGetFromWishlist', {})
+        self.assertOnce('sessionDeleteFromWishlist', body)
+
+    def testProfile(self):
+        self.assertOnce('profileGet', {})
+        self.assertOnce('profileSave', {'displayName': 'Renamed'})
+
+    def testNewProfile(self):
+        # the Profile is created on the first call, and read once on the next
+        self.assertOnce('profileGet', {}, user=NEW_USER)
+        self.assertOnce('profileGet', {}, user=NEW_USER)
+
+    def testUnauthorized(self):
+        status, counts = self.call('profileGet', {}, user=None)
+        self.assertEqual(401, status)
+        self.assertEqual({'get_current_user': 1, 'getUserId': 0, 'profileGets': 0}, counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
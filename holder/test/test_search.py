@@ -0,0 +1,63 @@
+"""
+searchQuery ranking and paging on testbed stubs.
+
+Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import search
+from endpoint_case import EndpointTestCase
+from models import Speaker
+
+
+class SearchQueryTest(EndpointTestCase):
+
+    def setUp(self):
+        super(SearchQueryTest, self).setUp()
+        # the bios rank the speakers: more mentions of the word weigh more
+        self.speakers = [Speaker(key=ndb.Key(Speaker, i + 1), name='Speaker %d' % i,
+                                 bio=' '.join(['python'] * (i + 1)))
+                         for i in range(5)]
+        ndb.put_multi(self.speakers)
+        search.index(self.speakers)
+
+    def pages(self, query, pageSize):
+        """Return (titles of every page in order, truncated flags) for the query."""
+        titles, truncated, token = [], [], None
+        while True:
+            body = {'query': query, 'pageSize': pageSize}
+            if token:
+                body['pageToken'] = token
+            answer = self.callOk('searchQuery', body, user=None)
+            titles.extend(item['title'] for item in answer.get('items', []))
+            truncated.append(answer.get('truncated', False))
+            token = answer.get('nextPageToken')
+            if not token:
+                return titles, truncated
+
+    def testPagesReadTheFirstPagesRanking(self):
+        titles, truncated = self.pages('python ', pageSize=2)
+        self.assertEqual(['Speaker %d' % i for i in reversed(range(5))], titles)
+        self.assertEqual([False] * 3, truncated)
+
+        # a better match indexed after the first page does not shift the later pages
+        self.speakers[0].bio = ' '.join(['python'] * 10)
+        search.index([self.speakers[0]])
+        answer = self.callOk('searchQuery', {'query': 'python ', 'pageSize': 2, 'pageToken': '2'},
+                             user=None)
+        self.assertEqual(['Speaker 2', 'Speaker 1'], [item['title'] for item in answer['items']])
+
+    def testTruncatedWhenMoreMatchThanRanked(self):
+        self.addCleanup(setattr, search, 'MAX_CANDIDATES', search.MAX_CANDIDATES)
+        search.MAX_CANDIDATES = 3
+        titles, truncated = self.pages('python ', pageSize=2)
+        self.assertEqual(3, len(titles))
+        self.assertEqual([True, True], truncated)
+
+
+if __name__ == '__main__':
+    unittest.main()
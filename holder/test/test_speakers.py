@@ -0,0 +1,65 @@
+"""
+Speaker endpoints on testbed stubs.
+
+Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import suggest
+from endpoint_case import EndpointTestCase
+from models import Speaker
+
+
+class SpeakerCreateBatchTest(EndpointTestCase):
+
+    def setUp(self):
+        super(SpeakerCreateBatchTest, self).setUp()
+        Speaker(key=ndb.Key(Speaker, 1), name='Taken', email='taken@example.com').put()
+
+    def testEmailsCheckedPerItem(self):
+        answer = self.callOk('speakerCreateBatch', {'items': [
+            {'name': 'No email'},
+            {'name': 'New email', 'email': 'new@example.com'},
+            {'name': 'Taken email', 'email': 'taken@example.com'},
+            {'name': 'Same email again', 'email': 'new@example.com'},
+        ]})
+        items = answer['items']
+        self.assertTrue(items[0].get('websafeKey'))
+        self.assertTrue(items[1].get('websafeKey'))
+        self.assertFalse(items[2].get('websafeKey'))
+        self.assertTrue(items[2].get('error'))
+        self.assertTrue(items[3].get('error'))
+        self.assertEqual(1, Speaker.query(Speaker.email == 'new@example.com').count())
+
+
+class SpeakerSuggestTest(EndpointTestCase):
+
+    def setUp(self):
+        super(SpeakerSuggestTest, self).setUp()
+        # a fresh instance: the first call builds the index from the datastore
+        suggest._index = suggest._SpeakerIndex()
+        ndb.put_multi([Speaker(key=ndb.Key(Speaker, 1), name='Ada Lovelace'),
+                       Speaker(key=ndb.Key(Speaker, 2), name='Alan Turing')])
+
+    def names(self, prefix):
+        answer = self.callOk('speakerSuggest', {'prefix': prefix}, user=None)
+        return sorted(item['name'] for item in answer.get('items', []))
+
+    def testFirstCallBuildsFromExistingSpeakers(self):
+        self.assertEqual(['Ada Lovelace', 'Alan Turing'], self.names('a'))
+        self.assertEqual(['Ada Lovelace'], self.names('love'))
+
+    def testCreatedSpeakerIsSuggested(self):
+        self.names('a')
+        self.callOk('speakerCreate', {'name': 'Grace Hopper'})
+        # the index checks the version stamp at most once per CHECK_INTERVAL
+        suggest._index._checked_at = 0
+        self.assertEqual(['Grace Hopper'], self.names('hop'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Caching of tokeninfo lookups (utils.getTokenInfo) on a stubbed urlfetch.
+
+Run from the project root:
+    python -m holder.runner SDK_PATH holder/test
+"""
+
+import json
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import utils
+
+INVALID_TOKEN = (400, json.dumps({'error': 'invalid_token'}))
+
+
+class TokenInfoStub(apiproxy_stub.APIProxyStub):
+    """urlfetch stub answering tokeninfo lookups from a token or (token type, token)
+    -> (status, body) map."""
+
+    def __init__(self):
+        super(TokenInfoStub, self).__init__('urlfetch')
+        self.responses = {}
+        self.fetched = []
+        self.types = []
+
+    def _Dynamic_Fetch(self, request, response):
+        token_type, token = request.url().rsplit('?', 1)[1].split('=', 1)
+        self.fetched.append(token)
+        self.types.append(token_type)
+        status, body = self.responses.get((token_type, token), self.responses.get(token, INVALID_TOKEN))
+        response.set_statuscode(status)
+        response.set_content(body)
+
+
+class Clock(object):
+    """Stands in for the time module in utils; it has no sleep, lookups must not block."""
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class TokenInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.urlfetch = TokenInfoStub()
+        self.testbed._register_stub(testbed.URLFETCH_SERVICE_NAME, self.urlfetch)
+        # one access_token lookup per fetch; the environment is restored on deactivate
+        os.environ['OAUTH_USER_ID'] = '1'
+
+        self.clock = Clock()
+        self._replace('time', self.clock)
+        self._replace('_tokeninfo_cache', utils._LruCache(utils.TOKENINFO_CACHE_SIZE))
+        self._replace('_tokeninfo_breaker', utils._CircuitBreaker(
+            'tokeninfo', utils.BREAKER_THRESHOLD, utils.BREAKER_COOLDOWN))
+
+    def _replace(self, name, value):
+        self.addCleanup(setattr, utils, name, getattr(utils, name))
+        setattr(utils, name, value)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def valid(self, token, expires_in=3600):
+        info = {'user_id': 'user-' + token, 'expires_in': expires_in}
+        self.urlfetch.responses[token] = (200, json.dumps(info))
+        return info
+
+    def lookups(self, token):
+        """Return how often token was fetched upstream so far."""
+        return self.urlfetch.fetched.count(token)
+
+    def testCacheHitSkipsFetch(self):
+        info = self.valid('a')
+        self.assertEqual(info, utils.getTokenInfo('a'))
+        self.assertEqual(info, utils.getTokenInfo('a'))
+        self.assertEqual(1, self.lookups('a'))
+
+        # a fresh instance finds it in memcache
+        utils._tokeninfo_cache = utils._LruCache(utils.TOKENINFO_CACHE_SIZE)
+        self.assertEqual(info, utils.getTokenInfo('a'))
+        self.assertEqual(1, self.lookups('a'))
+
+    def testTokensStoredHashed(self):
+        self.valid('a')
+        utils.getTokenInfo('a')
+        self.assertIsNone(memcache.get(utils.MEMCACHE_TOKENINFO_PREFIX + 'a'))
+
+    def testRejectionCachedForNegativeTtl(self):
+        self.assertEqual({}, utils.getTokenInfo('bad'))
+        self.clock.now += utils.TOKENINFO_NEGATIVE_TTL - 1
+        self.assertEqual({}, utils.getTokenInfo('bad'))
+        self.assertEqual(1, self.lookups('bad'))
+
+        self.clock.now += 2
+        self.assertEqual({}, utils.getTokenInfo('bad'))
+        self.assertEqual(2, self.lookups('bad'))
+
+    def testUpstreamFailureNotCached(self):
+        self.urlfetch.responses['a'] = (503, 'unavailable')
+        self.assertEqual({}, utils.getTokenInfo('a'))
+        self.assertEqual(utils.TOKENINFO_ATTEMPTS, self.lookups('a'))
+
+        info = self.valid('a')
+        self.assertEqual(info, utils.getTokenInfo('a'))
+
+    def testThrottlingNotCached(self):
+        self.urlfetch.responses['a'] = (429, 'rate limited')
+        self.assertEqual({}, utils.getTokenInfo('a'))
+        self.assertEqual(utils.TOKENINFO_ATTEMPTS, self.lookups('a'))
+
+        info = self.valid('a')
+        self.assertEqual(info, utils.getTokenInfo('a'))
+
+    def testAccessTokenOnlyAfterIdTokenRejected(self):
+        del os.environ['OAUTH_USER_ID']
+        self.valid('id')
+        utils.getTokenInfo('id')
+        self.assertEqual(['id_token'], self.urlfetch.types)
+
+        info = {'user_id': 'user-access', 'expires_in': 3600}
+        self.urlfetch.responses[('access_token', 'access')] = (200, json.dumps(info))
+        self.assertEqual(info, utils.getTokenInfo('access'))
+        self.assertEqual(['id_token', 'id_token', 'access_token'], self.urlfetch.types)
+
+    def testExpiryCappedAtExpiresIn(self):
+        self.valid('a', expires_in=60)
+        utils.getTokenInfo('a')
+        self.clock.now += 59
+        utils.getTokenInfo('a')
+        self.assertEqual(1, self.lookups('a'))
+
+        # expired in both the instance cache and memcache
+        self.clock.now += 2
+        utils.getTokenInfo('a')
+        self.assertEqual(2, self.lookups('a'))
+
+    def testLruEviction(self):
+        utils._tokeninfo_cache = utils._LruCache(2)
+        for token in ('a', 'b', 'c'):
+            self.valid(token)
+        utils.getTokenInfo('a')
+        utils.getTokenInfo('b')
+        # a is used again, so b is the least recently used when c comes in
+        utils.getTokenInfo('a')
+        utils.getTokenInfo('c')
+
+        memcache.flush_all()
+        for token in ('a', 'c', 'b'):
+            utils.getTokenInfo(token)
+        self.assertEqual([1, 1, 2], [self.lookups(token) for token in ('a', 'c', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+mailer.py -- batched, rate limited delivery of organizer email
+
+Confirmation and summary messages are not mailed from the request (or task)
+that produces them. queueMail() adds them to the MAIL_QUEUE pull queue,
+tagged with the recipient, and queues a digest task for the current
+DIGEST_WINDOW. When the window is over the digest task leases one
+recipient's messages and mails them as a single digest, one digest per task
+on the MAIL_SEND_QUEUE, whose rate in queue.yaml keeps delivery under the
+mail quota; a continuation task sends the next one. Each run is recorded as
+a MailBatch.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import json
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.runtime import apiproxy_errors
+
+from models import MailBatch
+
+MAIL_QUEUE = 'mail'
+MAIL_SEND_QUEUE = 'mail-send'
+DIGEST_WINDOW = 60  # seconds messages to one recipient are collected for
+DIGEST_LEASE = 60  # seconds
+DIGEST_BATCH = 100  # messages per digest at most
+
+
+def queueMail(email, subject, body):
+    """Queue a message to email for the next digest."""
+    taskqueue.Queue(MAIL_QUEUE).add(taskqueue.Task(
+        payload=json.dumps({'subject': subject, 'body': body}), method='PULL', tag=email))
+    _queueDigest()
+
+
+def _queueDigest(continuation=False, countdown=0):
+    """Enqueue sending the queued messages once the window is over; one per window."""
+    if continuation:
+        taskqueue.add(url='/tasks/send_mail_digest', queue_name=MAIL_SEND_QUEUE, countdown=countdown)
+        return
+    window = int(time.time() // DIGEST_WINDOW)
+    try:
+        taskqueue.add(url='/tasks/send_mail_digest', queue_name=MAIL_SEND_QUEUE,
+                      name='mail-digest-%d' % window, countdown=DIGEST_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # the digest for this window is already queued and will send this message
+        pass
+
+
+def _digest(messages):
+    """Return (subject, body) of one email carrying messages."""
+    if len(messages) == 1:
+        return messages[0]['subject'], messages[0]['body']
+    return ('Your conference updates (%d)' % len(messages),
+            '\r\n\r\n'.join(message['body'] for message in messages))
+
+
+def sendDigests():
+    """Mail the digest of the recipient with the oldest queued message; used by the digest task."""
+    queue = taskqueue.Queue(MAIL_QUEUE)
+    # all leased tasks share the tag, i.e. the recipient, of the oldest one
+    tasks = queue.lease_tasks_by_tag(DIGEST_LEASE, DIGEST_BATCH)
+    if not tasks:
+        return None
+    tasks.sort(key=lambda task: task.eta)
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    subject, body = _digest([json.loads(task.payload) for task in tasks])
+    batch = MailBatch()
+
+    try:
+        mail.send_mail(sender, tasks[0].tag, subject, body)
+        batch.digests += 1
+    except mail.Error as e:
+        # a bad address will not get better; drop the messages
+        logging.warning('Dropping %d message(s) to %s: %s', len(tasks), tasks[0].tag, e)
+        batch.failed += len(tasks)
+    except (apiproxy_errors.OverQuotaError, apiproxy_errors.DeadlineExceededError) as e:
+        # over the quota or timed out: leave the lease to lapse and send the
+        # messages in a task queued for when it has; anything else is a bug
+        # and fails the task
+        logging.warning('Deferring %d message(s) to %s: %r', len(tasks), tasks[0].tag, e)
+        batch.deferred += len(tasks)
+        _queueDigest(continuation=True, countdown=DIGEST_LEASE)
+        batch.put()
+        return batch
+
+    batch.messages += len(tasks)
+    queue.delete_tasks(tasks)
+    # there may be more; the queue's rate spaces out the next send
+    _queueDigest(continuation=True)
+    batch.put()
+    return batch
@@ -8,10 +8,15 @@ main.py -- Udacity conference server-side Python App Engine
 
 __author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
 
+import json
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
 from conference import ConferenceApi
+from utils import tokenInfoMetrics
+
+import backup
+import mailer
+import metrics
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -22,25 +27,176 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
+        """Queue email confirming Conference creation (tasks queued before digests)."""
+        mailer.queueMail(
+            self.request.get('email'),
+            'You created a new Conference!',
+            'Hi, you have created a following '
+            'conference:\r\n\r\n%s' % self.request.get('conferenceInfo')
         )
 
+class SendSessionSummaryHandler(webapp2.RequestHandler):
+    def post(self):
+        """Queue one email listing the Sessions a conference got in a window."""
+        body = ConferenceApi._sessionSummary(self.request)
+        if body:
+            mailer.queueMail(self.request.get('email'), 'You added new Sessions!', body)
+
+class SendMailDigestHandler(webapp2.RequestHandler):
+    def post(self):
+        """Mail the next recipient's queued messages as one digest."""
+        mailer.sendDigests()
+        self.response.set_status(204)
+
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Set Announcement in Memcache."""
         ConferenceApi._cacheFeaturedSpeaker(self.request)
         self.response.set_status(204)
 
-app = webapp2.WSGIApplication([
+class RebalanceSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Spread a conference's remaining seats over its shards."""
+        ConferenceApi._rebalanceSeats(self.request)
+        self.response.set_status(204)
+
+class RebuildAgendaHandler(webapp2.RequestHandler):
+    def post(self):
+        """Serialize a conference's Sessions into its materialized agenda."""
+        ConferenceApi._rebuildAgenda(self.request)
+        self.response.set_status(204)
+
+class CheckSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add or drop a conference from the nearly sold out Announcement."""
+        ConferenceApi._checkSeats(self.request)
+        self.response.set_status(204)
+
+class DrainRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Resolve queued registrations for a high demand conference."""
+        ConferenceApi._drainRegistrations(self.request)
+        self.response.set_status(204)
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's displayName onto their conferences."""
+        ConferenceApi._updateOrganizerName(self.request)
+        self.response.set_status(204)
+
+class ReindexHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index one batch of Conferences, Sessions or Speakers for search."""
+        ConferenceApi._reindex(self.request)
+        self.response.set_status(204)
+
+class StartReindexHandler(webapp2.RequestHandler):
+    def get(self):
+        """Queue rebuilding every search document (admin only)."""
+        ConferenceApi._queueReindex()
+        self.response.set_status(202)
+
+class MigrateAttendanceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move one batch of Profiles' registrations and wishlists into their own entities."""
+        ConferenceApi._migrateAttendance(self.request)
+        self.response.set_status(204)
+
+class StartMigrateAttendanceHandler(webapp2.RequestHandler):
+    def get(self):
+        """Queue migrating every Profile's registrations and wishlist (admin only)."""
+        ConferenceApi._queueAttendanceMigration()
+        self.response.set_status(202)
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show sampled per-endpoint latency and RPC stats (admin only)."""
+        stats = metrics.readStats(int(self.request.get('buckets') or metrics.STATS_BUCKETS))
+        # tokeninfo counters are per instance: this one's only
+        stats['tokenInfo'] = tokenInfoMetrics()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
+
+class ExportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Start an NDJSON export of the dataset (admin only)."""
+        job = backup.startExport()
+        self.response.set_status(202)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job.key.id()}))
+
+    def get(self):
+        """Show an export's progress, or download one of its chunks with ?chunk= (admin only)."""
+        job_id = int(self.request.get('job'))
+        chunk = self.request.get('chunk')
+        job, payload = backup.readExportChunk(job_id, int(chunk or 0))
+        if not job:
+            self.abort(404)
+        if not chunk:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({'job': job_id, 'chunks': job.chunks,
+                                            'count': job.count, 'done': job.done}))
+            return
+        if payload is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        self.response.headers['X-Export-Chunks'] = str(job.chunks)
+        self.response.headers['X-Export-Done'] = str(job.done).lower()
+        self.response.write(payload)
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Start an import, or upload chunk ?chunk= of NDJSON to ?job= (admin only)."""
+        self.response.headers['Content-Type'] = 'application/json'
+        if not self.request.get('job'):
+            job = backup.startImport()
+            self.response.write(json.dumps({'job': job.key.id()}))
+            return
+        job_id, chunk = int(self.request.get('job')), int(self.request.get('chunk'))
+        if len(self.request.body) > backup.MAX_IMPORT_CHUNK:
+            self.abort(400, detail='Chunks are limited to %d bytes; split it' % backup.MAX_IMPORT_CHUNK)
+        backup.addImportChunk(job_id, chunk, self.request.body)
+        self.response.set_status(202)
+        self.response.write(json.dumps({'job': job_id, 'chunk': chunk}))
+
+    def get(self):
+        """Show how many uploaded chunks of an import have been written (admin only)."""
+        job = backup.ImportJob.get_by_id(int(self.request.get('job')))
+        if not job:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job.key.id(), 'chunks': job.chunks, 'count': job.count}))
+
+class ExportTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Export one chunk of the dataset and queue the next."""
+        backup.exportChunk(int(self.request.get('job')), int(self.request.get('chunk')))
+        self.response.set_status(204)
+
+class ImportTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write one uploaded chunk of an import."""
+        backup.importChunk(int(self.request.get('job')), int(self.request.get('chunk')))
+        self.response.set_status(204)
+
+app = metrics.instrument(webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/send_session_summary', SendSessionSummaryHandler),
+    ('/tasks/send_mail_digest', SendMailDigestHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/rebalance_seats', RebalanceSeatsHandler),
+    ('/tasks/rebuild_agenda', RebuildAgendaHandler),
+    ('/tasks/check_seats', CheckSeatsHandler),
+    ('/tasks/drain_registrations', DrainRegistrationsHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/reindex', ReindexHandler),
+    ('/tasks/export', ExportTaskHandler),
+    ('/tasks/import', ImportTaskHandler),
+    ('/admin/reindex', StartReindexHandler),
+    ('/tasks/migrate_attendance', MigrateAttendanceHandler),
+    ('/admin/migrate_attendance', StartMigrateAttendanceHandler),
+    ('/admin/stats', StatsHandler),
+    ('/admin/export', ExportHandler),
+    ('/admin/import', ImportHandler),
+], debug=True))
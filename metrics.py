@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+metrics.py -- per-endpoint latency and RPC instrumentation
+
+instrument() wraps a WSGI application (conference.api, main.app). A sample
+of requests is recorded: wall time plus the datastore, memcache, taskqueue
+and urlfetch RPCs made while it ran, counted by API proxy hooks. Samples are
+aggregated in instance memory and flushed to memcache counters in one
+offset_multi call every FLUSH_INTERVAL seconds, into one set of counters per
+BUCKET_SECONDS window; readStats() merges the last windows into per-endpoint
+histograms for the admin stats handler.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SAMPLE_RATE = 0.1  # fraction of requests recorded
+FLUSH_INTERVAL = 10  # seconds between flushes of an instance's samples
+FLUSH_SAMPLES = 100  # flush early once this many samples are pending
+BUCKET_SECONDS = 300  # width of one rolling window
+STATS_BUCKETS = 24  # windows readStats merges at most (two hours)
+MEMCACHE_STATS_PREFIX = 'STATS:'
+MEMCACHE_STATS_NAMES_KEY = 'STATS_NAMES'
+LATENCY_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# (service, call) -> metric counted once per RPC
+RPC_METRICS = {
+    ('datastore_v3', 'Get'): 'datastore_get',
+    ('datastore_v3', 'Put'): 'datastore_put',
+    ('datastore_v3', 'Delete'): 'datastore_delete',
+    ('datastore_v3', 'RunQuery'): 'datastore_query',
+    ('datastore_v3', 'Next'): 'datastore_next',
+    ('datastore_v3', 'Commit'): 'datastore_commit',
+    ('urlfetch', 'Fetch'): 'urlfetch',
+}
+METRICS = ('calls', 'errors', 'total_ms', 'memcache_hit', 'memcache_miss', 'memcache_set',
+           'taskqueue_add') + tuple(sorted(set(RPC_METRICS.values()))) + \
+    tuple('le_%d' % bound for bound in LATENCY_BOUNDS_MS) + ('le_inf',)
+
+_local = threading.local()
+
+
+class _Recorder(object):
+    """Counts the RPCs made by one sampled request."""
+
+    def __init__(self):
+        self.counts = {}
+
+    def incr(self, metric, delta=1):
+        if delta:
+            self.counts[metric] = self.counts.get(metric, 0) + delta
+
+
+def _rpcHook(service, call, request, response):
+    """API proxy post-call hook; counts the RPC against the request being sampled."""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return
+    metric = RPC_METRICS.get((service, call))
+    if metric:
+        recorder.incr(metric)
+    elif service == 'memcache':
+        if call == 'Get':
+            hits = response.item_size()
+            recorder.incr('memcache_hit', hits)
+            recorder.incr('memcache_miss', request.key_size() - hits)
+        elif call == 'Set':
+            recorder.incr('memcache_set', request.item_size())
+    elif service == 'taskqueue' and call == 'BulkAdd':
+        recorder.incr('taskqueue_add', request.add_request_size())
+
+
+class _Aggregator(object):
+    """Thread-safe per-instance buffer of samples waiting to be flushed."""
+
+    def __init__(self):
+        self._pending = {}
+        self._samples = 0
+        self._names = set()
+        self._known_names = set()
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed_ms, error, counts):
+        bound = next(('le_%d' % b for b in LATENCY_BOUNDS_MS if elapsed_ms <= b), 'le_inf')
+        counts = dict(counts, calls=1, total_ms=int(elapsed_ms), errors=int(error))
+        counts[bound] = 1
+        now = time.time()
+        with self._lock:
+            pending = self._pending.setdefault(name, {})
+            for metric, delta in counts.items():
+                pending[metric] = pending.get(metric, 0) + delta
+            self._samples += 1
+            if name not in self._known_names:
+                self._names.add(name)
+            if self._samples < FLUSH_SAMPLES and now < self._last_flush + FLUSH_INTERVAL:
+                return
+            pending, self._pending, self._samples = self._pending, {}, 0
+            names, self._names = self._names, set()
+            self._last_flush = now
+        self._flush(pending, names, now)
+
+    def _flush(self, pending, names, now):
+        """Add the pending counts to this window's memcache counters (one RPC).
+
+        Counters have no expiry (offset_multi cannot set one); windows older
+        than readStats looks at are simply never read again and get evicted.
+        """
+        bucket = int(now // BUCKET_SECONDS)
+        deltas = {}
+        for name, counts in pending.items():
+            for metric, delta in counts.items():
+                deltas['%d:%s:%s' % (bucket, name, metric)] = delta
+        memcache.offset_multi(deltas, key_prefix=MEMCACHE_STATS_PREFIX, initial_value=0)
+        if names and _addNames(names):
+            with self._lock:
+                self._known_names.update(names)
+
+
+_aggregator = _Aggregator()
+
+
+def _addNames(names):
+    """Add endpoint names to the memcache index of recorded names; True on success."""
+    client = memcache.Client()
+    for attempt in range(3):
+        known = client.gets(MEMCACHE_STATS_NAMES_KEY)
+        if known is None:
+            if client.add(MEMCACHE_STATS_NAMES_KEY, sorted(names)):
+                return True
+            continue
+        if names.issubset(known):
+            return True
+        if client.cas(MEMCACHE_STATS_NAMES_KEY, sorted(names.union(known))):
+            return True
+    return False
+
+
+def _requestName(environ):
+    """Name requests by path; endpoints calls arrive as /_ah/spi/ConferenceApi.<method>."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/_ah/spi/'):
+        return path[len('/_ah/spi/'):]
+    return path
+
+
+def instrument(app, sample_rate=None):
+    """Wrap a WSGI application so a sample of its requests is recorded."""
+    hooks = apiproxy_stub_map.apiproxy.GetPostCallHooks()
+    # Append() ignores the same hook added twice, so wrapping several apps is fine
+    hooks.Append('metrics', _rpcHook)
+
+    def instrumented(environ, start_response):
+        rate = SAMPLE_RATE if sample_rate is None else sample_rate
+        if random.random() >= rate:
+            return app(environ, start_response)
+
+        status = []
+
+        def recordStatus(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+
+        recorder = _local.recorder = _Recorder()
+        started = time.time()
+        try:
+            return app(environ, recordStatus)
+        finally:
+            _local.recorder = None
+            code = int(status[0].split()[0]) if status else 500
+            # unrouted paths would grow the set of names without bound
+            if code != 404:
+                _aggregator.add(_requestName(environ), (time.time() - started) * 1000,
+                                code >= 500, recorder.counts)
+    return instrumented
+
+
+def _percentile(histogram, calls, pct):
+    """Upper latency bound (ms) of the histogram bucket holding the pct percentile."""
+    seen = 0
+    for bound in LATENCY_BOUNDS_MS:
+        seen += histogram.get('le_%d' % bound, 0)
+        if seen >= calls * pct / 100.0:
+            return bound
+    return None  # beyond the largest bound
+
+
+def readStats(buckets=STATS_BUCKETS):
+    """Return per-endpoint stats for the last buckets windows, merged."""
+    names = memcache.get(MEMCACHE_STATS_NAMES_KEY) or []
+    current = int(time.time() // BUCKET_SECONDS)
+    keys = ['%d:%s:%s' % (bucket, name, metric)
+            for bucket in range(current - min(buckets, STATS_BUCKETS) + 1, current + 1)
+            for name in names
+            for metric in METRICS]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_STATS_PREFIX)
+
+    totals = {}
+    for key, value in values.items():
+        name, metric = key.split(':', 1)[1].rsplit(':', 1)
+        counts = totals.setdefault(name, {})
+        counts[metric] = counts.get(metric, 0) + int(value)
+
+    stats = {}
+    for name, counts in totals.items():
+        calls = counts.get('calls', 0)
+        if not calls:
+            continue
+        histogram = dict((metric, counts.get(metric, 0)) for metric in METRICS if metric.startswith('le_'))
+        lookups = counts.get('memcache_hit', 0) + counts.get('memcache_miss', 0)
+        stats[name] = {
+            'sampledCalls': calls,
+            'errors': counts.get('errors', 0),
+            'meanMs': round(float(counts.get('total_ms', 0)) / calls, 1),
+            'p50Ms': _percentile(histogram, calls, 50),
+            'p95Ms': _percentile(histogram, calls, 95),
+            'p99Ms': _percentile(histogram, calls, 99),
+            'latencyHistogram': histogram,
+            'perCall': dict((metric, round(float(counts[metric]) / calls, 2)) for metric in METRICS
+                            if metric not in histogram and metric not in ('calls', 'errors', 'total_ms')
+                            and counts.get(metric)),
+            'memcacheHitRate': round(float(counts.get('memcache_hit', 0)) / lookups, 3) if lookups else None,
+        }
+    return {
+        'sampleRate': SAMPLE_RATE,
+        'windowSeconds': BUCKET_SECONDS * min(buckets, STATS_BUCKETS),
+        'endpoints': stats,
+    }
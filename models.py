@@ -12,20 +12,39 @@ __author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
 import httplib
 import endpoints
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+MEMCACHE_ETAG_PREFIX = 'ETAG:'
+ETAG_LOCK = 2  # seconds a changed stamp cannot be re-added by a reader that loaded the old data
+
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class NotModifiedException(endpoints.ServiceException):
+    """NotModifiedException -- exception mapped to HTTP 304 response"""
+    http_status = httplib.NOT_MODIFIED
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName             = ndb.StringProperty()
     mainEmail               = ndb.StringProperty()
     teeShirtSize            = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy: moved to Registration and WishlistEntry children, emptied by the migration
     conferencesToAttend     = ndb.KeyProperty(repeated=True)
     sessionsWishlist        = ndb.KeyProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- a Profile attending a Conference; child of the Profile, id is the conference's key path"""
+    conferenceKey   = ndb.KeyProperty(required=True, kind='Conference')
+    created         = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- a Session on a Profile's wishlist; child of the Profile, id is the session's key path"""
+    sessionKey      = ndb.KeyProperty(required=True, kind='Session')
+    created         = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName     = messages.StringField(1)
@@ -37,6 +56,16 @@ class ProfileForm(messages.Message):
     mainEmail               = messages.StringField(2)
     teeShirtSize            = messages.EnumField('TeeShirtSize', 3)
 
+class BatchResultForm(messages.Message):
+    """BatchResultForm -- outcome of one item of a batch create"""
+    index           = messages.IntegerField(1, variant=messages.Variant.INT32)
+    websafeKey      = messages.StringField(2)  # set if the item was created
+    error           = messages.StringField(3)  # set if it was not
+
+class BatchResultForms(messages.Message):
+    """BatchResultForms -- outcomes of a batch create, in request order"""
+    items = messages.MessageField(BatchResultForm, 1, repeated=True)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -50,6 +79,7 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty(required=True)
+    organizerDisplayName = ndb.StringProperty()  # copy of the organizer's Profile.displayName
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -57,6 +87,19 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0)  # 0 means seats are counted on the entity
+    highDemand      = ndb.BooleanProperty(default=False)  # queue registrations instead of running them inline
+    version         = ndb.IntegerProperty(default=0, indexed=False)  # bumped by every update, for ETags
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- singleton set of conferences with 1 to 5 seats left"""
+    conferences     = ndb.JsonProperty(default={})  # websafe conference key -> name
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's available seats"""
+    conferenceKey   = ndb.KeyProperty(required=True, kind='Conference')
+    seats           = ndb.IntegerProperty(default=0, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -72,10 +115,13 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    highDemand      = messages.BooleanField(13)
+    etag            = messages.StringField(14)  # outbound only
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -95,6 +141,27 @@ class TeeShirtSize(messages.Enum):
     XXXL_M = 14
     XXXL_W = 15
 
+class RegistrationTicket(ndb.Model):
+    """RegistrationTicket -- queued registration request, child of Profile"""
+    conferenceKey   = ndb.KeyProperty(required=True, kind='Conference')
+    status          = ndb.StringProperty(default='PENDING')
+    reason          = ndb.StringProperty(indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class RegistrationStatus(messages.Enum):
+    """RegistrationStatus -- registration ticket status enumeration value"""
+    PENDING = 1
+    REGISTERED = 2
+    REJECTED = 3
+
+class RegistrationForm(messages.Message):
+    """RegistrationForm -- outbound registration result, with ticket if queued"""
+    data            = messages.BooleanField(1)  # same tag as BooleanMessage.data
+    websafeTicketKey = messages.StringField(2)
+    status          = messages.EnumField('RegistrationStatus', 3)
+    reason          = messages.StringField(4)
+    websafeConferenceKey = messages.StringField(5)
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -104,6 +171,8 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
 
 # - - - - - - - - - - Session Models - - - - - - - - -
 class Session(ndb.Model):
@@ -116,6 +185,14 @@ class Session(ndb.Model):
     typeOfSession   = ndb.StringProperty()
     date            = ndb.DateProperty()
     startTime       = ndb.TimeProperty()
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class Agenda(ndb.Model):
+    """Agenda -- a conference's sessions as encoded SessionForms; child of the Conference"""
+    version         = ndb.IntegerProperty(default=0, indexed=False)  # bumped by every session write
+    builtVersion    = ndb.IntegerProperty(indexed=False)  # version payload was built at
+    payload         = ndb.BlobProperty(compressed=True)
+    updated         = ndb.DateTimeProperty(auto_now=True)
 
 class SessionInForm(messages.Message):
     """SessionInForm -- Session inbound form object"""
@@ -129,6 +206,10 @@ class SessionInForm(messages.Message):
     startTime       = messages.StringField(8)
     websafeKey      = messages.StringField(9)  # session websafe key
 
+class SessionInForms(messages.Message):
+    """SessionInForms -- multiple Session inbound form message"""
+    items = messages.MessageField(SessionInForm, 1, repeated=True)
+
 class SessionOutForm(messages.Message):
     """SessionOutForm -- Session outbound form object"""
     name            = messages.StringField(1)
@@ -150,6 +231,9 @@ class SessionOutForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionOutForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)  # set by sessionGetByConference
+    speakers = messages.MessageField('SpeakerForm', 4, repeated=True)  # compact responses: each speaker once
 
 
 # - - - - - - - - - - Speaker Models - - - - - - - - -
@@ -160,6 +244,16 @@ class Speaker(ndb.Model):
     credentials     = ndb.StringProperty(repeated=True)
     title           = ndb.StringProperty()
     email           = ndb.StringProperty()
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    version         = ndb.IntegerProperty(default=0, indexed=False)  # bumped by every write, for ETags
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        # drop the tag speakerGet remembers for the old data; new speakers have none
+        if self.version > 1:
+            memcache.delete(MEMCACHE_ETAG_PREFIX + self.key.urlsafe(), seconds=ETAG_LOCK)
 
 class SpeakerForm(messages.Message):
     """SpeakerForm -- Speaker outbound form"""
@@ -169,9 +263,90 @@ class SpeakerForm(messages.Message):
     title           = messages.StringField(4)
     email           = messages.StringField(5)
     websafeKey      = messages.StringField(6)
+    etag            = messages.StringField(7)  # outbound only
 
 
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple Speaker outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class SpeakerSessions(ndb.Model):
+    """SpeakerSessions -- a speaker's sessions at one conference; child of the Conference"""
+    speakerKey      = ndb.KeyProperty(required=True, kind='Speaker')
+    speakerName     = ndb.StringProperty(indexed=False)
+    sessionNames    = ndb.StringProperty(repeated=True, indexed=False)
+    count           = ndb.IntegerProperty(default=0)
+    featured        = ndb.ComputedProperty(lambda self: self.count >= 2)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+
+
+# - - - - - - - - - - Search Models - - - - - - - - -
+class SearchDocument(ndb.Model):
+    """SearchDocument -- search terms of a Conference, Session or Speaker; keyed by its websafe key"""
+    entityKind      = ndb.StringProperty(required=True)
+    targetKey       = ndb.KeyProperty(required=True)
+    title           = ndb.StringProperty(indexed=False)
+    tokens          = ndb.StringProperty(repeated=True)
+    prefixes        = ndb.StringProperty(repeated=True)
+    weights         = ndb.JsonProperty()  # token -> weight
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+
+class SearchResultForm(messages.Message):
+    """SearchResultForm -- one search hit outbound form message"""
+    kind            = messages.StringField(1)
+    websafeKey      = messages.StringField(2)
+    title           = messages.StringField(3)
+    score           = messages.FloatField(4)
+
+
+class SearchResultForms(messages.Message):
+    """SearchResultForms -- multiple search hits outbound form message"""
+    items = messages.MessageField(SearchResultForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    truncated = messages.BooleanField(3)  # more matched than search.MAX_CANDIDATES; only those were ranked
+
+
+# - - - - - - - - - - Backup Models - - - - - - - - -
+class ExportJob(ndb.Model):
+    """ExportJob -- progress of an NDJSON export; the checkpoint the export task resumes from"""
+    kinds           = ndb.StringProperty(repeated=True, indexed=False)
+    kindIndex       = ndb.IntegerProperty(default=0, indexed=False)  # kind being exported
+    cursor          = ndb.StringProperty(indexed=False)  # where that kind's next chunk starts
+    chunks          = ndb.IntegerProperty(default=0, indexed=False)
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ExportChunk(ndb.Model):
+    """ExportChunk -- one chunk of NDJSON records; child of the ExportJob, id is its number + 1"""
+    kind            = ndb.StringProperty(indexed=False)
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+    payload         = ndb.BlobProperty(compressed=True)
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- an NDJSON import, uploaded chunk by chunk"""
+    chunks          = ndb.IntegerProperty(default=0, indexed=False)  # chunks fully written
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ImportChunk(ndb.Model):
+    """ImportChunk -- one uploaded chunk of NDJSON records; child of the ImportJob"""
+    payload         = ndb.BlobProperty(compressed=True)
+    linesDone       = ndb.IntegerProperty(default=0, indexed=False)  # checkpoint within the chunk
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+
 
+# - - - - - - - - - - Mail Models - - - - - - - - - -
+class MailBatch(ndb.Model):
+    """MailBatch -- what one run of the mail digest task sent"""
+    digests         = ndb.IntegerProperty(default=0, indexed=False)  # emails sent
+    messages        = ndb.IntegerProperty(default=0, indexed=False)  # queued messages taken off the queue
+    failed          = ndb.IntegerProperty(default=0, indexed=False)  # dropped for a bad address
+    deferred        = ndb.IntegerProperty(default=0, indexed=False)  # left queued, over the mail quota or failed to send
+    created         = ndb.DateTimeProperty(auto_now_add=True)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+search.py -- full-text search over conferences, sessions and speakers
+
+Each searchable entity has a root SearchDocument keyed by the entity's
+websafe key, holding its lowercase tokens, the prefixes of those tokens and
+a weight per token (name fields count more than descriptions). A query is an
+AND of equality filters on tokens, the last term matching prefixes, which
+the datastore answers from its built-in indexes; the candidates are then
+ranked by the summed weights of the terms they match. The ranking is kept
+in memcache for a few minutes, so the later pages of a query are read from
+it instead of fetching and ranking the candidates again.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import hashlib
+import json
+import re
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+
+MIN_PREFIX = 2
+MAX_PREFIX = 10
+MAX_TOKENS = 200  # per document
+MAX_TERMS = 8  # per query
+MAX_CANDIDATES = 500  # documents ranked per query
+PREFIX_WEIGHT = 0.5  # share of a token's weight a prefix match earns
+MEMCACHE_RANKING_PREFIX = 'SEARCH_RANKING:'
+RANKING_TTL = 300  # seconds a query's ranking serves its later pages
+
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+                       'it', 'of', 'on', 'or', 'the', 'to', 'with'])
+
+# kind -> ((field, weight), ...) indexed for it; the first field is the title
+FIELDS = {
+    'Conference': (('name', 3), ('topics', 2), ('description', 1)),
+    'Session': (('name', 3), ('highlights', 1)),
+    'Speaker': (('name', 3), ('credentials', 2), ('bio', 1)),
+}
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Split text into lowercase words, dropping stopwords."""
+    return [word for word in _WORD.findall((text or '').lower()) if word not in STOPWORDS]
+
+
+def _prefixes(token):
+    """Return the prefixes of token that queries can match, shortest first."""
+    return [token[:i] for i in range(MIN_PREFIX, min(len(token), MAX_PREFIX) + 1)]
+
+
+def document(entity):
+    """Return the (unsaved) SearchDocument for a Conference, Session or Speaker."""
+    kind = entity.key.kind()
+    weights = {}
+    for field, weight in FIELDS[kind]:
+        value = getattr(entity, field)
+        for text in (value if isinstance(value, list) else [value]):
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + weight
+
+    # keep the heaviest tokens if a long bio or description runs over
+    tokens = sorted(weights, key=lambda token: (-weights[token], token))[:MAX_TOKENS]
+    prefixes = set()
+    for token in tokens:
+        prefixes.update(_prefixes(token))
+    return SearchDocument(
+        id=entity.key.urlsafe(),
+        entityKind=kind,
+        targetKey=entity.key,
+        title=getattr(entity, FIELDS[kind][0][0]),
+        tokens=tokens,
+        prefixes=sorted(prefixes),
+        weights=dict((token, weights[token]) for token in tokens),
+    )
+
+
+def index(entities):
+    """Write the SearchDocuments for entities in one batch."""
+    ndb.put_multi([document(entity) for entity in entities if entity])
+
+
+def _score(doc, terms, prefix):
+    """Sum the weights of the query terms in the document; prefix matches the last term."""
+    score = sum(doc.weights.get(term, 0) for term in terms)
+    if prefix:
+        if prefix in doc.weights:
+            score += doc.weights[prefix]
+        else:
+            score += PREFIX_WEIGHT * max(weight for token, weight in doc.weights.items()
+                                         if token.startswith(prefix))
+    return score
+
+
+def _rankingKey(terms, prefix, kinds):
+    """Return the memcache key of the ranking for a parsed query."""
+    query = json.dumps([terms, prefix, sorted(kinds or [])])
+    return MEMCACHE_RANKING_PREFIX + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def _rank(terms, prefix, kinds):
+    """Fetch and rank the candidates of a parsed query; returns
+    ([(score, SearchDocument)] best first, truncated)."""
+    query = SearchDocument.query()
+    for term in terms:
+        query = query.filter(SearchDocument.tokens == term)
+    if prefix:
+        query = query.filter(SearchDocument.prefixes == prefix)
+    if kinds:
+        query = query.filter(SearchDocument.entityKind.IN(list(kinds)))
+
+    docs = query.fetch(MAX_CANDIDATES + 1)
+    ranked = sorted(((_score(doc, terms, prefix), doc) for doc in docs[:MAX_CANDIDATES]),
+                    key=lambda pair: (-pair[0], pair[1].title))
+    return ranked, len(docs) > MAX_CANDIDATES
+
+
+def search(text, kinds=None, offset=0, limit=20):
+    """Return ([(score, SearchDocument)], more, truncated) for a query, best first.
+
+    Every term must match a token; unless the query ends in a space its last
+    term only needs to start a token. At most MAX_CANDIDATES documents are
+    ranked, the first ones in key order; truncated is True when more matched,
+    so deep pages of very broad queries are cut off. A page past the first
+    reads the ranking its query stored within RANKING_TTL, so the pages of one
+    query do not overlap or skip hits.
+    """
+    terms = tokenize(text)[:MAX_TERMS]
+    if not terms:
+        return [], False, False
+    prefix = None
+    if not text[-1:].isspace() and len(terms[-1]) >= MIN_PREFIX:
+        prefix = terms.pop()[:MAX_PREFIX]
+
+    key = _rankingKey(terms, prefix, kinds)
+    cached = memcache.get(key) if offset else None
+    if cached is None:
+        ranked, truncated = _rank(terms, prefix, kinds)
+        memcache.set(key, ([(score, doc.key.id()) for score, doc in ranked], truncated), time=RANKING_TTL)
+        return ranked[offset:offset + limit], len(ranked) > offset + limit, truncated
+
+    ranking, truncated = cached
+    page = ranking[offset:offset + limit]
+    docs = ndb.get_multi([ndb.Key(SearchDocument, doc_id) for score, doc_id in page])
+    # documents deleted since the query was ranked are dropped from the page
+    hits = [(score, doc) for (score, doc_id), doc in zip(page, docs) if doc]
+    return hits, len(ranking) > offset + limit, truncated
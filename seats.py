@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+seats.py -- sharded seat counters for conference registration
+
+A conference's available seats are split across several root SeatShard
+entities so that concurrent registrations write to different entity
+groups instead of all contending on the Conference entity.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+SEAT_SHARDS = 10
+CLAIM_ATTEMPTS = 3
+
+
+def _shardKey(c_key, index):
+    """Return the key of shard number index for the conference key."""
+    # root entity named after the conference path so shards sit in their own groups
+    path = '/'.join(str(part) for part in c_key.flat())
+    return ndb.Key(SeatShard, '%s/%d' % (path, index))
+
+
+def shardKeys(conf):
+    """Return all shard keys for a conference (empty if it is not sharded)."""
+    return [_shardKey(conf.key, i) for i in range(conf.seatShards or 0)]
+
+
+def createShards(c_key, seats, num_shards=SEAT_SHARDS):
+    """Return (unsaved) shards splitting seats as evenly as possible."""
+    per_shard, remainder = divmod(max(seats, 0), num_shards)
+    return [SeatShard(key=_shardKey(c_key, i), conferenceKey=c_key,
+                      seats=per_shard + (1 if i < remainder else 0))
+            for i in range(num_shards)]
+
+
+def getSeatsAvailable(confs):
+    """Return a dict of conference key -> seats available, reading every shard in one batch."""
+    seats = {}
+    keys = []
+    for conf in confs:
+        if conf.seatShards:
+            keys.extend(shardKeys(conf))
+        else:
+            # conferences created before sharding keep their count on the entity
+            seats[conf.key] = conf.seatsAvailable
+
+    for shard in ndb.get_multi(keys):
+        if shard:
+            seats[shard.conferenceKey] = seats.get(shard.conferenceKey, 0) + shard.seats
+    for conf in confs:
+        seats.setdefault(conf.key, 0)
+    return seats
+
+
+def pickShards(conf):
+    """Return up to CLAIM_ATTEMPTS shards with seats left, in random order."""
+    shards = [shard for shard in ndb.get_multi(shardKeys(conf)) if shard and shard.seats > 0]
+    random.shuffle(shards)
+    return shards[:CLAIM_ATTEMPTS]
+
+
+def randomShardKey(conf):
+    """Return the key of a random shard of the conference."""
+    return _shardKey(conf.key, random.randrange(conf.seatShards))
+
+
+@ndb.transactional(xg=True)
+def rebalanceShards(conf_key, seats=None):
+    """Spread the conference's seats evenly over its shards.
+
+    If seats is given the total is reset to that value, otherwise the current
+    total is redistributed. The aggregate is also written back onto the
+    Conference so datastore queries on seatsAvailable stay roughly current.
+    """
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return None
+
+    shards = ndb.get_multi(shardKeys(conf))
+    if seats is None:
+        seats = sum(shard.seats for shard in shards if shard)
+
+    shards = createShards(conf.key, seats, conf.seatShards)
+    conf.seatsAvailable = seats
+    ndb.put_multi(shards + [conf])
+    return seats
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+suggest.py -- speaker name autocomplete
+
+Every instance keeps a sorted array of (normalized name, websafe key, name)
+entries, one per word a speaker's name can be completed from, and answers
+prefixes by binary search, so lookups never touch the datastore. The array
+is built once per instance and refreshed when the SPEAKER_SUGGEST_VERSION
+memcache stamp, bumped by every speakerCreate, changes: only speakers
+created since the newest one the instance has seen are read and merged in.
+"""
+
+__author__ = 'stevenbarnhurst@gmail.com (Steven Barnhurst)'
+
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from datetime import timedelta
+
+from google.appengine.api import memcache
+
+from models import Speaker
+
+MEMCACHE_VERSION_KEY = 'SPEAKER_SUGGEST_VERSION'
+CHECK_INTERVAL = 1  # seconds between looks at the version stamp
+OVERLAP = timedelta(seconds=60)  # re-read window for speakers the global query showed late
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Lowercase text, strip accents and collapse whitespace."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    text = unicodedata.normalize('NFKD', text or u'')
+    text = u''.join(char for char in text if not unicodedata.combining(char))
+    return _SPACES.sub(u' ', text.lower()).strip()
+
+
+def _entries(key, name):
+    """Return the entries completing name from each of its words ('ada lovelace', 'lovelace')."""
+    words = normalize(name).split(u' ')
+    websafe = key.urlsafe()
+    return [(u' '.join(words[i:]), websafe, name) for i in range(len(words)) if words[i]]
+
+
+class _SpeakerIndex(object):
+    """Per-instance sorted array of speaker name entries."""
+
+    def __init__(self):
+        self._entries = []
+        self._keys = set()
+        self._version = None
+        self._watermark = None  # newest Speaker.created merged in
+        self._checked_at = 0
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Build or top up the array if the version stamp moved; at most once per CHECK_INTERVAL."""
+        now = time.time()
+        if self._built and now < self._checked_at + CHECK_INTERVAL:
+            return
+        with self._lock:
+            if self._built and now < self._checked_at + CHECK_INTERVAL:
+                return
+            self._checked_at = now
+            version = memcache.get(MEMCACHE_VERSION_KEY)
+            if self._built and version == self._version:
+                return
+
+            topUp = self._watermark is not None
+            if topUp:
+                # top up with the speakers created since the last refresh
+                speakers = Speaker.query(Speaker.created > self._watermark - OVERLAP).fetch()
+            else:
+                # full build; names only, bios can be long
+                speakers = Speaker.query().fetch(projection=[Speaker.name])
+                newest = Speaker.query().order(-Speaker.created).fetch(1, projection=[Speaker.created])
+                self._watermark = newest[0].created if newest else None
+
+            added = []
+            for speaker in speakers:
+                if speaker.key in self._keys:
+                    continue
+                self._keys.add(speaker.key)
+                added.extend(_entries(speaker.key, speaker.name))
+                # projected full build entities have no created; reading it would raise
+                if topUp and speaker.created and speaker.created > self._watermark:
+                    self._watermark = speaker.created
+            if added:
+                # readers keep using the old list until the new one is swapped in
+                self._entries = sorted(self._entries + added)
+            self._version = version
+            self._built = True
+
+    def suggest(self, prefix, limit):
+        """Return up to limit (websafe key, name) pairs whose name has a word starting with prefix."""
+        self._refresh()
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        entries = self._entries
+        found, seen = [], set()
+        for i in xrange(bisect.bisect_left(entries, (prefix,)), len(entries)):
+            completion, websafe, name = entries[i]
+            if not completion.startswith(prefix):
+                break
+            if websafe not in seen:
+                seen.add(websafe)
+                found.append((websafe, name))
+                if len(found) >= limit:
+                    break
+        return found
+
+
+_index = _SpeakerIndex()
+
+
+def suggest(prefix, limit):
+    """Return up to limit (websafe key, name) pairs of speakers matching prefix."""
+    return _index.suggest(prefix, limit)
+
+
+def speakerAdded():
+    """Bump the version stamp so every instance picks up a new speaker."""
+    memcache.incr(MEMCACHE_VERSION_KEY, initial_value=0)
@@ -1,12 +1,236 @@
+import hashlib
 import json
+import logging
 import os
+import random
+import threading
 import time
 import uuid
+from collections import OrderedDict
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 from models import Conference
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+MEMCACHE_TOKENINFO_PREFIX = 'TOKENINFO:'
+TOKENINFO_CACHE_SIZE = 1000
+TOKENINFO_NEGATIVE_TTL = 30  # seconds a rejected token is remembered
+TOKENINFO_BUDGET = 5.0  # seconds for all attempts of one lookup together
+TOKENINFO_ATTEMPTS = 3
+TOKENINFO_DEADLINE = 1.0  # seconds for the first attempt; doubled per retry, with jitter
+BREAKER_THRESHOLD = 5  # consecutive upstream failures that open the breaker
+BREAKER_COOLDOWN = 30  # seconds an open breaker fails fast before a trial call
+
+
+class _LruCache(object):
+    """Thread-safe, size-bounded LRU of key -> value with per-entry expiry."""
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+
+class _CircuitBreaker(object):
+    """Thread-safe circuit breaker for an upstream service.
+
+    Closed: calls go through. After BREAKER_THRESHOLD consecutive failures it
+    opens and calls fail fast; after BREAKER_COOLDOWN seconds one trial call
+    is let through (half-open) and its outcome closes or re-opens it. A trial
+    that has not reported back within BREAKER_COOLDOWN seconds is given up on
+    and another one is let through.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self, now):
+        with self._lock:
+            if self.state != self.CLOSED and now >= self._opened_at + self._cooldown:
+                # open long enough, or the half-open trial never reported back
+                self._opened_at = now
+                if self.state != self.HALF_OPEN:
+                    self._setState(self.HALF_OPEN)
+                return True
+            return self.state == self.CLOSED
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self._setState(self.CLOSED)
+
+    def failure(self, now):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self._threshold:
+                self._opened_at = now
+                if self.state != self.OPEN:
+                    self._setState(self.OPEN)
+
+    def _setState(self, state):
+        logging.warning('%s circuit breaker %s -> %s', self.name, self.state, state)
+        self.state = state
+
+
+class _Counters(object):
+    """Thread-safe named counters."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, delta=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + delta
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+_tokeninfo_cache = _LruCache(TOKENINFO_CACHE_SIZE)
+_tokeninfo_breaker = _CircuitBreaker('tokeninfo', BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+_tokeninfo_counters = _Counters()
+
+
+def tokenInfoMetrics():
+    """Return this instance's tokeninfo counters and circuit breaker state."""
+    metrics = _tokeninfo_counters.snapshot()
+    metrics['breaker_state'] = _tokeninfo_breaker.state
+    metrics['breaker_failures'] = _tokeninfo_breaker.failures
+    return metrics
+
+
+def _fetchTokenInfo(token):
+    """Look the token up at the tokeninfo endpoint.
+
+    Returns the tokeninfo, {} if the upstream rejected the token, or None if
+    it could not be asked (breaker open, upstream errors, budget spent).
+
+    The token is looked up as an id token and, only if that is rejected, as
+    an access token. Every attempt is a urlfetch RPC whose deadline doubles
+    per retry, with jitter, within what is left of TOKENINFO_BUDGET: retries
+    back off by waiting longer on the upstream, never by sleeping, and one
+    lookup never holds the request longer than the budget. Upstream failures
+    feed the circuit breaker, which fails fast while the upstream is down.
+    """
+    started = time.time()
+    give_up_at = started + TOKENINFO_BUDGET
+    if not _tokeninfo_breaker.allow(started):
+        _tokeninfo_counters.incr('short_circuited')
+        return None
+
+    token_types = ['id_token', 'access_token']
+    if 'OAUTH_USER_ID' in os.environ:
+        token_types = ['access_token']
+
+    info = None
+    try:
+        attempt = 0
+        while token_types and attempt < TOKENINFO_ATTEMPTS:
+            remaining = give_up_at - time.time()
+            if remaining <= 0:
+                _tokeninfo_counters.incr('budget_exhausted')
+                break
+            if attempt:
+                _tokeninfo_counters.incr('retries')
+            _tokeninfo_counters.incr('attempts')
+
+            deadline = TOKENINFO_DEADLINE * 2 ** attempt * random.uniform(0.5, 1)
+            rpc = urlfetch.create_rpc(deadline=min(deadline, remaining))
+            urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_types[0], token))
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                resp = None
+
+            if resp and resp.status_code == 200:
+                info = json.loads(resp.content)
+                return info
+            if resp and resp.status_code == 400:
+                # not a valid token of this type; try the next type straight away
+                token_types.pop(0)
+                continue
+            # upstream error, throttling (429) or timeout: retry
+            _tokeninfo_counters.incr('upstream_errors')
+            attempt += 1
+
+        if not token_types:
+            # the upstream answered every lookup; the token is just not valid
+            _tokeninfo_counters.incr('rejected')
+            info = {}
+            return info
+        return None
+    finally:
+        # also reached when the lookup raised, so a half-open trial always reports back
+        if info is None:
+            _tokeninfo_breaker.failure(time.time())
+            _tokeninfo_counters.incr('failures')
+        else:
+            _tokeninfo_breaker.success()
+
+
+def getTokenInfo(token):
+    """Return tokeninfo for a bearer token, cached in instance memory and memcache.
+
+    Entries live until the token's own expires_in; tokens the upstream
+    rejected are remembered for TOKENINFO_NEGATIVE_TTL seconds, lookups that
+    failed upstream are not remembered. Tokens are only ever stored hashed.
+    """
+    key = hashlib.sha256(token).hexdigest()
+    now = time.time()
+
+    info = _tokeninfo_cache.get(key, now)
+    if info is not None:
+        return info
+
+    cached = memcache.get(MEMCACHE_TOKENINFO_PREFIX + key)
+    if cached and cached[0] > now:
+        _tokeninfo_cache.set(key, cached[1], cached[0])
+        return cached[1]
+
+    info = _fetchTokenInfo(token)
+    if info is None:
+        # the upstream could not be asked; that says nothing about the token
+        return {}
+    try:
+        ttl = int(info.get('expires_in', 0)) if info else TOKENINFO_NEGATIVE_TTL
+    except (TypeError, ValueError):
+        ttl = 0
+    if ttl > 0:
+        _tokeninfo_cache.set(key, info, now + ttl)
+        memcache.set(MEMCACHE_TOKENINFO_PREFIX + key, (now + ttl, info), time=ttl)
+    return info
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -15,25 +239,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getTokenInfo(token).get('user_id', '')
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm